@@ -0,0 +1,106 @@
+#Batched least-squares fitter for the "gaus(0)+pol0(3)" model used on the pad-group timing projections.
+#All projections (rows) are fitted at the same time with a Levenberg-Marquardt iteration in numpy.
+#The parameter limits are hard box limits (a parameter on a limit is held there while the gradient points
+#outwards), which gives the same bounded minimum as the Minuit fits in generalFunctions.fit_2d_histogram.
+#Code by Jacob Steenis, 2024/2025
+import numpy as np
+
+N_PARAMS = 4 #amplitude, mean, sigma, constant
+
+#Per-row fit status
+CONVERGED = 0
+STALLED = 1
+MAX_ITERATIONS = 2
+
+def gaus_pol0(x, params):
+    amplitude, mean, sigma, constant = (params[:, i, None] for i in range(N_PARAMS))
+    return amplitude*np.exp(-0.5*((x - mean)/sigma)**2) + constant
+
+def gaus_pol0_jacobian(x, params):
+    amplitude, mean, sigma, constant = (params[:, i, None] for i in range(N_PARAMS))
+    pull = (x - mean)/sigma
+    gaus = np.exp(-0.5*pull**2)
+    return np.stack([
+                gaus,
+                amplitude*gaus*pull/sigma,
+                amplitude*gaus*pull**2/sigma,
+                np.ones_like(gaus)
+            ], axis=-1)
+
+# Fits y(x) +- errors for every row at once.
+#   x:          (n_points,) bin centers shared by all rows
+#   y, errors:  (n_rows, n_points) bin contents and errors
+#   use_points: (n_rows, n_points) which points enter the chi2 (fit range, non-empty bins)
+#   initial, lower, upper: (n_rows, 4) starting values and limits
+# Returns the fitted parameters, the chi2 and a per-row status: CONVERGED, STALLED (no step improves the chi2 any more
+# before it has settled, the damping blew up) or MAX_ITERATIONS. Only CONVERGED rows can be trusted.
+def fit_gaus_pol0(x, y, errors, use_points, initial, lower, upper, max_iterations=200, tolerance=1e-9):
+    # Only the points that enter some fit are worth carrying through the iterations
+    used_points = np.flatnonzero(use_points.any(axis=0))
+    x = np.asarray(x, dtype=np.float64)[used_points]
+    y, errors, use_points = y[:, used_points], errors[:, used_points], use_points[:, used_points]
+
+    n_rows = y.shape[0]
+    weights = np.where(use_points & (errors > 0), 1/np.where(errors > 0, errors, 1), 0)
+
+    lower, upper = np.asarray(lower, dtype=np.float64), np.asarray(upper, dtype=np.float64)
+    params = np.clip(np.asarray(initial, dtype=np.float64), lower, upper)
+
+    def chi2_of(params):
+        residuals = (y - gaus_pol0(x, params))*weights
+        return residuals, (residuals**2).sum(axis=1)
+
+    residuals, chi2 = chi2_of(params)
+    damping = np.ones(n_rows) #Start cautious so the fit stays in the basin of the starting values, like Minuit
+    status = np.full(n_rows, MAX_ITERATIONS, dtype=np.int64)
+    active = np.ones(n_rows, dtype=bool)
+    identity = np.eye(N_PARAMS)
+
+    for iteration in range(max_iterations):
+        if not active.any():
+            break
+
+        rows = np.flatnonzero(active)
+        jacobian = gaus_pol0_jacobian(x, params[rows])*weights[rows, :, None]
+        alpha = np.einsum('rpi,rpj->rij', jacobian, jacobian)
+        beta = np.einsum('rpi,rp->ri', jacobian, residuals[rows])
+
+        # Parameters on a limit that the gradient pushes outwards are held there for this step
+        held = ((params[rows] <= lower[rows]) & (beta < 0)) | ((params[rows] >= upper[rows]) & (beta > 0))
+        free = ~held
+        alpha = alpha*free[:, :, None]*free[:, None, :] + identity*held[:, :, None]
+        beta = beta*free
+
+        diagonal = np.einsum('rii->ri', alpha)
+        diagonal = np.maximum(diagonal, 1e-12*diagonal.max(axis=1, keepdims=True) + 1e-300)
+        damped = alpha + np.einsum('ri,ij->rij', damping[rows, None]*diagonal, identity)
+        try:
+            step = np.linalg.solve(damped, beta[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(d, b, rcond=None)[0] for d, b in zip(damped, beta)])
+
+        trial = params.copy()
+        trial[rows] = np.clip(params[rows] + step, lower[rows], upper[rows])
+        trial_residuals, trial_chi2 = chi2_of(trial)
+
+        improved = np.zeros(n_rows, dtype=bool)
+        improved[rows] = trial_chi2[rows] <= chi2[rows]
+        change = np.abs(chi2 - trial_chi2)
+
+        accept = np.flatnonzero(improved)
+        params[accept] = trial[accept]
+        residuals[accept] = trial_residuals[accept]
+        chi2[accept] = trial_chi2[accept]
+        damping[accept] = np.maximum(damping[accept]/10, 1e-12)
+
+        reject = rows[~improved[rows]]
+        damping[reject] *= 10
+
+        # Converged once an accepted step no longer changes the chi2; stalled when only infinitely small steps are left
+        converged = improved & (change <= tolerance*np.maximum(chi2, 1)) & active
+        stalled = (damping > 1e12) & active & ~converged
+        status[converged] = CONVERGED
+        status[stalled] = STALLED
+        active &= ~(converged | stalled)
+
+    return params, chi2, status
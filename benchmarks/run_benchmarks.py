@@ -0,0 +1,260 @@
+#End-to-end benchmark on synthetic ntuples (see synthetic_ntuples.py), so performance can be measured without EOS access.
+#Times every stage of the chain: ntuple ingestion, muon-cluster matching and cluster expansion (generate_mcdonalds_plots.py),
+#hotPadRemover, fit_2d_histogram, applier and int_optimizer (run.py) and the check renderers (check_delay_plots.sh),
+#reports events/s and seconds per chamber, and checks that the injected group delays and hot pads are recovered.
+#Usage: python3 benchmarks/run_benchmarks.py [--events N] [--chambers N] [--fit_backend numpy] [--optimizer analytic] [-o results.json]
+#Code by Jacob Steenis, 2024/2025
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import contextlib
+import collections
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, ".."))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "checking_scripts"))
+import mcdonaldsClasses
+from mcdonaldsClasses import mcdonaldsProducer, make_tasks, run_tasks, write_mcdonalds_outputs
+from mcdonaldsStore import mcdonaldsStore
+from delayClasses import delayGenerator, generalFunctions, delayOutputWriter, FIT_BACKENDS, OPTIMIZERS
+from run import process_chamber
+from render_checks import render_checks
+from setup import ensure_folders_exist
+from synthetic_ntuples import generate_run, PADS_PER_GROUP
+
+#Wall and CPU time of every named stage. Stages can be timed with measure() or by wrapping a function/method with wrap().
+#Wrapped calls are timed inclusively, e.g. the fit_2d_histogram calls made inside int_optimizer count for both.
+class stageTimer():
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.patched = []
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage["wall"] += time.perf_counter() - wall_start
+            stage["cpu"] += time.process_time() - cpu_start
+            stage["calls"] += 1
+
+    def wrap(self, owner, attribute, name):
+        original = getattr(owner, attribute)
+        def timed(*args, **kwargs):
+            with self.measure(name):
+                return original(*args, **kwargs)
+        setattr(owner, attribute, timed)
+        self.patched.append((owner, attribute, original))
+
+    def restore(self):
+        for owner, attribute, original in reversed(self.patched):
+            setattr(owner, attribute, original)
+        self.patched = []
+
+    def wall(self, name):
+        return self.stages.get(name, {"wall": 0.0})["wall"]
+
+#The pipeline prints a lot per chamber; without --verbose only the benchmark report is shown
+@contextlib.contextmanager
+def quiet(verbose):
+    if verbose:
+        yield
+        return
+    with open(os.devnull, "w") as sink, contextlib.redirect_stdout(sink):
+        yield
+
+def run_ingestion(timer, ntuple_dir, run, verbose=False):
+    producer = mcdonaldsProducer()
+    files = sorted(os.path.join(ntuple_dir, str(run), name) for name in os.listdir(os.path.join(ntuple_dir, str(run))) if name.endswith(".root"))
+    tasks = make_tasks(files)
+    n_events = sum(task["entry_stop"] - task["entry_start"] for task in tasks)
+
+    timer.wrap(mcdonaldsProducer, "process_task", "stage 1 tasks")
+    timer.wrap(mcdonaldsClasses, "match_clusters", "matching")
+    timer.wrap(mcdonaldsProducer, "fill_table", "expansion")
+    try:
+        with quiet(verbose), timer.measure("generate_mcdonalds_plots"):
+            hits = run_tasks(producer, tasks)
+            output_baseName = f"GEM_mcdonalds_data/run{run}/"
+            ensure_folders_exist("GEM_mcdonalds_data", [f"run{run}"])
+            with timer.measure("mcdonalds store"):
+                write_mcdonalds_outputs(hits, output_baseName)
+    finally:
+        timer.restore()
+
+    # Reading the ntuples and the muon selection are what is left of the task time
+    ingestion = timer.stages["stage 1 tasks"]
+    timer.stages["ingestion"] = {
+                                    "wall": ingestion["wall"] - timer.wall("matching") - timer.wall("expansion"),
+                                    "cpu": ingestion["cpu"] - timer.stages["matching"]["cpu"] - timer.stages["expansion"]["cpu"],
+                                    "calls": ingestion["calls"]
+                                }
+    return n_events
+
+def run_delays(timer, run, options, verbose=False):
+    baseName = f"GEM_delays/run{run}"
+    mcdonalds_dir = f"GEM_mcdonalds_data/run{run}/"
+    with quiet(verbose):
+        ensure_folders_exist(baseName, ["delays", "verification_plots", "verification_plots/final", "verification_plots/initial", "verification_plots/intermediate"])
+
+    store = mcdonaldsStore(mcdonalds_dir)
+    files = sorted(mcdonalds_dir+name+".root" for name in store.chamber_names())
+
+    timer.wrap(delayGenerator, "hotPadRemover", "hotPadRemover")
+    timer.wrap(generalFunctions, "fit_2d_histogram", "fit_2d_histogram")
+    timer.wrap(delayGenerator, "applier", "applier")
+    timer.wrap(delayGenerator, "int_optimizer", "int_optimizer")
+    results = {}
+    try:
+        with quiet(verbose), timer.measure("run.py"):
+            writer = delayOutputWriter(baseName)
+            for input_file_name in files:
+                result = process_chamber(input_file_name, store, None, options)
+                if result is None:
+                    continue
+                writer.add(*result[:3])
+                results[input_file_name.split("/")[-1].replace(".root","")] = result
+            writer.write()
+    finally:
+        timer.restore()
+    return results
+
+def run_checks(timer, run, verbose_checks=False, jobs=1, verbose=False):
+    with quiet(verbose), timer.measure("check renderers"):
+        render_checks(f"run{run}", verbose=verbose_checks, jobs=jobs)
+
+#A group counts as recovered when its delay plus its injected offset is within max_difference BX of the chamber's most
+#common value (the common part is set by the reference point and the base time). The fitted group means scatter by a
+#few tenths of a BX at the default statistics, so some groups round to the neighbouring integer delay.
+def check_recovery(truth, results, max_difference=1):
+    recovery = {}
+    for name, chamber_truth in truth.items():
+        if name not in results:
+            recovery[name] = {"found": False}
+            continue
+
+        group_df, _, hot_channels, _ = results[name]
+        groups = group_df["padID"].to_numpy()//PADS_PER_GROUP
+        offsets = np.array(chamber_truth["group_offsets"])[groups]
+        total = group_df["bunchDelay"].to_numpy() + offsets
+        values, counts = np.unique(total, return_counts=True)
+        common = values[np.argmax(counts)]
+
+        found_hot = set(hot_channels.get(name, []))
+        injected_hot = set(pad + 1 for pad in chamber_truth["hot_pads"]) #x bins of the McDonalds plot
+        recovery[name] = {
+                            "found": True,
+                            "groups": int(len(groups)),
+                            "exact_fraction": float(np.mean(total == common)),
+                            "within_fraction": float(np.mean(np.abs(total - common) <= max_difference)),
+                            "hot_pads_found": sorted(injected_hot & found_hot),
+                            "hot_pads_missed": sorted(injected_hot - found_hot),
+                            "false_hot_pads": sorted(found_hot - injected_hot)
+                        }
+    return recovery
+
+def report(timer, n_events, n_chambers, recovery, min_fraction):
+    print("\n\033[1;32mStage timings\033[0m")
+    print(f"{'stage':<28}{'wall [s]':>10}{'cpu [s]':>10}{'calls':>8}")
+    for name in ["ingestion", "matching", "expansion", "mcdonalds store", "generate_mcdonalds_plots",
+                    "hotPadRemover", "fit_2d_histogram", "applier", "int_optimizer", "run.py", "check renderers"]:
+        if name in timer.stages:
+            stage = timer.stages[name]
+            print(f"{name:<28}{stage['wall']:>10.3f}{stage['cpu']:>10.3f}{stage['calls']:>8}")
+    print("(hotPadRemover, fit_2d_histogram, applier and int_optimizer are inclusive: int_optimizer contains its own fits)")
+
+    events_per_second = n_events/max(timer.wall("generate_mcdonalds_plots"), 1e-9)
+    seconds_per_chamber = timer.wall("run.py")/max(n_chambers, 1)
+    print(f"\nStage 1: {events_per_second:.0f} events/s ({n_events} events)")
+    print(f"Stage 2: {seconds_per_chamber:.2f} s per chamber ({n_chambers} chambers)")
+
+    passed = True
+    print("\n\033[1;32mRecovery of the injected delays\033[0m")
+    for name, result in recovery.items():
+        if not result["found"]:
+            print(f"\033[91m{name}: no delays were made!\033[0m")
+            passed = False
+            continue
+
+        chamber_passed = result["within_fraction"] >= min_fraction and not result["hot_pads_missed"]
+        passed &= chamber_passed
+        color = "\033[32m" if chamber_passed else "\033[91m"
+        print(
+                f"{color}{name}: {100*result['exact_fraction']:.1f}% of groups exact, {100*result['within_fraction']:.1f}% within 1 BX, "
+                f"hot pads found {result['hot_pads_found']}, missed {result['hot_pads_missed']}\033[0m"
+            )
+
+    return {"events_per_second": events_per_second, "seconds_per_chamber": seconds_per_chamber, "passed": passed}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=20000, help='Number of synthetic events')
+    parser.add_argument('--files', type=int, default=2, help='Number of synthetic ntuple files')
+    parser.add_argument('--chambers', type=int, default=4, help='Number of chambers with hits')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the synthetic ntuples')
+    parser.add_argument('-r', '--run', type=int, default=999999, help='Run number of the synthetic run')
+    parser.add_argument('--fit_backend', type=str, default="root", choices=FIT_BACKENDS, help='Fit backend of run.py')
+    parser.add_argument('--optimizer', type=str, default="refit", choices=OPTIMIZERS, help='Reference point optimizer of run.py')
+    parser.add_argument('--optimize_steps', type=int, default=None, help='Number of reference point offsets (default: 5 for refit, 120 for analytic)')
+    parser.add_argument('--verbose_checks', action='store_true', help='Also render every individual group fit (check_delay_plots.sh -v)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes for the check renderers')
+    parser.add_argument('--min_fraction', type=float, default=0.95, help='Fraction of groups per chamber that must be recovered within 1 BX')
+    parser.add_argument('--workdir', type=str, default=None, help='Directory for the ntuples and outputs (default: a temporary directory that is removed afterwards)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directory')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write the timings and the recovery results to this json file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the pipeline itself')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    output = None if args.output is None else os.path.abspath(args.output)
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="gem_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    start_dir = os.getcwd()
+    os.chdir(workdir) #All outputs (GEM_mcdonalds_data, GEM_delays) are relative to the working directory
+    print("Benchmark directory: ", workdir)
+
+    num_optimize_steps = args.optimize_steps
+    if num_optimize_steps is None:
+        num_optimize_steps = 120 if args.optimizer == "analytic" else 5
+
+    options = {
+                "rebin_num": 8,
+                "num_optimize_steps": num_optimize_steps,
+                "reference_point": 7,
+                "SPECIFY_RUN": args.run,
+                "fit_backend": args.fit_backend,
+                "write_intermediate": False,
+                "optimizer": args.optimizer
+            }
+
+    timer = stageTimer()
+    try:
+        with quiet(args.verbose), timer.measure("synthetic ntuples"):
+            truth = generate_run("ntuples", args.run, n_events=args.events, n_files=args.files, seed=args.seed, n_chambers=args.chambers)
+
+        n_events = run_ingestion(timer, "ntuples", args.run, verbose=args.verbose)
+        results = run_delays(timer, args.run, options, verbose=args.verbose)
+        run_checks(timer, args.run, verbose_checks=args.verbose_checks, jobs=args.jobs, verbose=args.verbose)
+
+        recovery = check_recovery(truth, results)
+        summary = report(timer, n_events, len(results), recovery, args.min_fraction)
+
+        if output is not None:
+            with open(output, "w") as f:
+                json.dump({"settings": vars(args), "stages": timer.stages, "recovery": recovery, **summary}, f, indent=1)
+            print("\nOutput", output, "made!")
+
+    finally:
+        os.chdir(start_dir)
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.exit(0 if summary["passed"] else 1)
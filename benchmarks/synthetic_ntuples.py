@@ -0,0 +1,189 @@
+#Writes synthetic GEM common ntuples (muNtupleProducer/MuDPGTree with the 18 branches read by generate_mcdonalds_plots.py)
+#so that the whole chain can be run and timed without EOS access.
+#Every chamber gets an integer timing offset per pad group (8 pads) on top of a common base time, plus a few hot pads
+#that fire at random BXs. The injected values are written to truth.json next to the ntuples, so the delays found by
+#run.py can be checked against them (see run_benchmarks.py).
+#Usage: python3 benchmarks/synthetic_ntuples.py -o [output dir] -r [run number] --events [number of events]
+#       then python3 generate_mcdonalds_plots.py --input_dir [output dir] -r [run number]
+#Code by Jacob Steenis, 2024/2025
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import awkward as ak
+import uproot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from mcdonaldsClasses import tree_name, muon_variables, cluster_variables, chamber_info, chamber_names, N_PADS
+
+PADS_PER_ETA = 192
+PADS_PER_GROUP = 8
+N_GROUPS = N_PADS//PADS_PER_GROUP
+
+#Same shift as shiftingBX with the default CSCConstants_LCT_CENTRAL_BX=8 and tmbL1aWindowSize=7
+BX_SHIFT = 8 - int(7/2.0)
+
+TRUTH_FILE = "truth.json"
+
+#The injected timing of every chamber: chamber name -> base time, per-group integer offsets and hot pads (expanded pad IDs)
+def make_truth(rng, n_chambers=4, max_offset=2, n_hot_pads=2, base_range=(4.0, 4.8)):
+    #Only station 1 chambers pass the muon selection
+    ge11 = [idx for idx, info in enumerate(chamber_info) if info[0]==1]
+    chamber_indices = sorted(rng.choice(ge11, size=n_chambers, replace=False).tolist())
+
+    truth = {}
+    for idx in chamber_indices:
+        truth[chamber_names[idx]] = {
+                                        "chamber_idx": idx,
+                                        "base_time": float(rng.uniform(*base_range)),
+                                        "group_offsets": rng.integers(0, max_offset+1, N_GROUPS).tolist(),
+                                        "hot_pads": sorted(rng.choice(N_PADS, size=n_hot_pads, replace=False).tolist())
+                                    }
+    return truth
+
+#Flat per-muon and per-cluster columns of n_events events. Every selected muon leaves a cluster near its pad
+#(with the timing of its pad group), a fraction of the muons fail the selection and every event has noise clusters.
+def generate_events(rng, n_events, truth, muons_per_event=1.5, noise_clusters=4, efficiency=0.9, hot_fraction=0.1, sigma=0.6):
+    names = list(truth.keys())
+    infos = [chamber_info[truth[name]["chamber_idx"]] for name in names]
+    base_times = np.array([truth[name]["base_time"] for name in names])
+    offsets = np.array([truth[name]["group_offsets"] for name in names])
+    hot_pads = np.array([truth[name]["hot_pads"] for name in names], dtype=np.int64).reshape(len(names), -1)
+
+    # Muons
+    n_muons = rng.poisson(muons_per_event, n_events)
+    total_muons = int(n_muons.sum())
+    muon_chamber = rng.integers(0, len(names), total_muons)
+    station, region, chamber, layer = (np.array([info[i] for info in infos])[muon_chamber] for i in range(4))
+
+    eta = rng.integers(1, 9, total_muons)
+    strip = rng.uniform(0, 2*PADS_PER_ETA, total_muons)
+    pt = rng.exponential(20, total_muons)
+    is_me11 = rng.random(total_muons) < 0.95
+    outermost_z = region*rng.uniform(500, 1000, total_muons)*np.where(rng.random(total_muons) < 0.95, 1, -1)
+
+    # Hot pads fire at random times, so a muon passing one picks up a cluster with a random BX
+    hot = np.zeros(total_muons, dtype=bool)
+    hot_pad = np.zeros(total_muons, dtype=np.int64)
+    if hot_pads.shape[1] > 0:
+        hot = rng.random(total_muons) < hot_fraction
+        hot_pad = hot_pads[muon_chamber, rng.integers(0, hot_pads.shape[1], total_muons)]
+    eta = np.where(hot, 8 - hot_pad//PADS_PER_ETA, eta)
+    strip = np.where(hot, 2*(hot_pad%PADS_PER_ETA) + 0.5, strip)
+
+    # The signal cluster of every muon, kept inside the pad group of its first pad
+    signal = rng.random(total_muons) < efficiency
+    first_pad = np.clip(np.floor(strip/2).astype(np.int64) + rng.integers(-2, 3, total_muons), 0, PADS_PER_ETA - 1)
+    first_pad = np.where(hot, hot_pad%PADS_PER_ETA, first_pad)
+    size = np.minimum(rng.integers(1, 5, total_muons), PADS_PER_GROUP - first_pad%PADS_PER_GROUP)
+    size = np.where(hot, 1, size)
+
+    group = (first_pad + (8 - eta)*PADS_PER_ETA)//PADS_PER_GROUP
+    true_time = base_times[muon_chamber] + offsets[muon_chamber, group]
+    gem_bx = np.rint(rng.normal(true_time, sigma)).astype(np.int64)
+    gem_bx = np.where(hot, rng.integers(0, 15, total_muons), gem_bx)
+    alct_match_time = rng.integers(0, 3, total_muons)
+    pad_bx = gem_bx - BX_SHIFT + alct_match_time
+
+    # Noise clusters anywhere on the same chambers (they rarely match a muon)
+    n_noise = rng.poisson(noise_clusters, n_events)
+    total_noise = int(n_noise.sum())
+    noise_chamber = rng.integers(0, len(names), total_noise)
+    noise_info = [np.array([info[i] for info in infos])[noise_chamber] for i in range(4)]
+
+    # Clusters of every event: its signal clusters first, then its noise clusters
+    muon_event = np.repeat(np.arange(n_events), n_muons)
+    cluster_event = np.concatenate([muon_event[signal], np.repeat(np.arange(n_events), n_noise)])
+    order = np.argsort(cluster_event, kind='stable')
+    n_clusters = np.bincount(cluster_event, minlength=n_events)
+
+    def clusters(signal_values, noise_values):
+        return np.concatenate([signal_values[signal], noise_values])[order]
+
+    muon_columns = {
+                        "mu_propagated_isME11": is_me11,
+                        "mu_propagated_station": station.astype(np.int32),
+                        "mu_propagated_region": region.astype(np.int32),
+                        "mu_propagated_Outermost_z": outermost_z.astype(np.float32),
+                        "mu_propagated_etaP": eta.astype(np.int32),
+                        "mu_propagated_pt": pt.astype(np.float32),
+                        "mu_propagated_chamber": chamber.astype(np.int32),
+                        "mu_propagated_strip": strip.astype(np.float32),
+                        "mu_propagated_layer": layer.astype(np.int32)
+                    }
+
+    cluster_columns = {
+                        "gemPadDigiCluster_layer": clusters(layer, noise_info[3]).astype(np.int32),
+                        "gemPadDigiCluster_station": clusters(station, noise_info[0]).astype(np.int32),
+                        "gemPadDigiCluster_region": clusters(region, noise_info[1]).astype(np.int32),
+                        "gemPadDigiCluster_ClusterFirstPad": clusters(first_pad, rng.integers(0, PADS_PER_ETA, total_noise)).astype(np.int32),
+                        "gemPadDigiCluster_PadBX": clusters(pad_bx, rng.integers(0, 8, total_noise)).astype(np.int32),
+                        "gemPadDigiCluster_PadClusterSize": clusters(size, rng.integers(1, 5, total_noise)).astype(np.int32),
+                        "gemPadDigiCluster_etaPartition": clusters(eta, rng.integers(1, 9, total_noise)).astype(np.int32),
+                        "gemPadDigiCluster_chamber": clusters(chamber, noise_info[2]).astype(np.int32),
+                        "gemPadDigiCluster_ClusterALCTMatchTime": clusters(alct_match_time, rng.integers(0, 3, total_noise)).astype(np.int32)
+                    }
+
+    branches = {name: ak.unflatten(values, n_muons) for name, values in muon_columns.items()}
+    branches.update({name: ak.unflatten(values, n_clusters) for name, values in cluster_columns.items()})
+    return {name: branches[name] for name in cluster_variables + muon_variables}
+
+#Writes the branches to file_path, basket_entries events per basket
+def write_ntuple(file_path, branches, basket_entries=2500):
+    n_events = len(next(iter(branches.values())))
+    with uproot.recreate(file_path) as output_file:
+        tree = output_file.mktree(tree_name, {name: str(ak.type(values).content) for name, values in branches.items()})
+        for start in range(0, n_events, basket_entries):
+            tree.extend({name: values[start:start+basket_entries] for name, values in branches.items()})
+
+#Writes n_files ntuples with n_events events in total to output_dir/[run] and the injected truth to output_dir/[run]/truth.json
+def generate_run(output_dir, run, n_events=20000, n_files=2, seed=1, n_chambers=4, max_offset=2, n_hot_pads=2,
+                    muons_per_event=1.5, noise_clusters=4, basket_entries=2500):
+    rng = np.random.default_rng(seed)
+    run_dir = os.path.join(output_dir, str(run))
+    os.makedirs(run_dir, exist_ok=True)
+
+    truth = make_truth(rng, n_chambers=n_chambers, max_offset=max_offset, n_hot_pads=n_hot_pads)
+    for i, file_events in enumerate(np.array_split(np.arange(n_events), n_files)):
+        branches = generate_events(rng, len(file_events), truth, muons_per_event=muons_per_event, noise_clusters=noise_clusters)
+        file_path = os.path.join(run_dir, f"synthetic_{i}.root")
+        write_ntuple(file_path, branches, basket_entries=basket_entries)
+        print("Output", file_path, "made!")
+
+    with open(os.path.join(run_dir, TRUTH_FILE), "w") as f:
+        json.dump({"seed": seed, "n_events": n_events, "chambers": truth}, f, indent=1)
+    return truth
+
+def load_truth(output_dir, run):
+    with open(os.path.join(output_dir, str(run), TRUTH_FILE)) as f:
+        return json.load(f)["chambers"]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output_dir', type=str, default="synthetic_ntuples", help='Output directory (the ntuples go to [output dir]/[run number])')
+    parser.add_argument('-r', '--run', type=int, default=999999, help='Run number of the synthetic run')
+    parser.add_argument('--events', type=int, default=20000, help='Number of events in total')
+    parser.add_argument('--files', type=int, default=2, help='Number of ntuple files')
+    parser.add_argument('--chambers', type=int, default=4, help='Number of GE1/1 chambers with hits')
+    parser.add_argument('--muons', type=float, default=1.5, help='Mean number of muons per event')
+    parser.add_argument('--noise', type=float, default=4, help='Mean number of noise clusters per event')
+    parser.add_argument('--max_offset', type=int, default=2, help='Largest injected group timing offset [BX]')
+    parser.add_argument('--hot_pads', type=int, default=2, help='Number of hot pads per chamber')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate_run(
+                    args.output_dir,
+                    args.run,
+                    n_events=args.events,
+                    n_files=args.files,
+                    seed=args.seed,
+                    n_chambers=args.chambers,
+                    max_offset=args.max_offset,
+                    n_hot_pads=args.hot_pads,
+                    muons_per_event=args.muons,
+                    noise_clusters=args.noise
+                )
@@ -4,6 +4,7 @@
 VERBOSE=0
 CHECK_INITIAL_ONLY=0
 RUN_NUMBER=-1
+JOBS=1
 
 # Function to print messages only in verbose mode
 log_verbose() {
@@ -30,6 +31,15 @@ while [[ $# -gt 0 ]]; do
                 return 1
             fi
             ;;
+	-j|--jobs)
+            if [[ -n "$2" && ! "$2" =~ ^- ]]; then
+                JOBS="$2"
+                shift
+            else
+                echo "Error: --jobs requires a numeric argument."
+                return 1
+            fi
+            ;;
 
         *)
             echo "Unknown option: $1"
@@ -39,71 +49,19 @@ while [[ $# -gt 0 ]]; do
     shift
 done
 
-current_dir=$(pwd 2>/dev/null)
-
-# Determine subfolder name
+# All the pdfs are rendered by checking_scripts/render_checks.py (with JOBS worker processes)
+render_args=(-j "$JOBS")
 if [[ "$RUN_NUMBER" != "-1" ]]; then
-    RUN_SUBFOLDER="run${RUN_NUMBER}"
-else
-    echo "YOU ARE RUNNING THE DEFAULT VERSION. IT'S BEST TO INSTEAD SPECIFY A RUN NUMBER WITH -r"
-    RUN_SUBFOLDER="default"
-fi
-
-# Construct paths
-initial_root_dir="$current_dir/GEM_delays/${RUN_SUBFOLDER}/verification_plots/initial"
-final_root_dir="$current_dir/GEM_delays/${RUN_SUBFOLDER}/verification_plots/final"
-delays_dir="$current_dir/GEM_delays/${RUN_SUBFOLDER}/delays"
-mcdonalds_dir="$current_dir/GEM_mcdonalds_data/${RUN_SUBFOLDER}"
-
-if [[ "$CHECK_INITIAL_ONLY" -eq 1 ]]; then
-    echo
-    echo "Running only initial 2D distribution check..."
-    python3 checking_scripts/check_2d_distributions.py "$mcdonalds_dir" "$mcdonalds_dir"/initial_mcdonalds_distributions.pdf "GE*.root" ""
-    echo
-    return 0
+    render_args+=(-r "$RUN_NUMBER")
 fi
 
-#For the verbose case, we output the individual canvas pdfs and the initial 2d distributions
 if [[ "$VERBOSE" -eq 1 ]]; then
-    echo
-    log_verbose "Verbose mode is ON. Outputting the 2d initial data and the individual canvas fits"
-    echo
-
-    for root_file in "$final_root_dir"/finalFitInformation*.root; do
-        if [ -f "$root_file" ]; then
-            echo "Processing file: $root_file"
-            python3 checking_scripts/check_canvases.py ${root_file} ${root_file/.root/_check.pdf} 
-        echo "Processing completed for $root_file"
-        fi
-    done
-
-    echo
-
-    for root_file in "$initial_root_dir"/fitInformation*.root; do
-        if [ -f "$root_file" ]; then
-            echo "Processing file: $root_file"
-    	    python3 checking_scripts/check_canvases.py ${root_file} ${root_file/.root/_check.pdf} 
-            echo "Processing completed for $root_file"
-        fi
-    done
-
-    echo
+    render_args+=(-v)
+fi
 
-    python3 checking_scripts/check_2d_distributions.py $delays_dir "$initial_root_dir"/initial_mcdonalds_distributions.pdf
-    echo
-    python3 checking_scripts/check_2d_distributions.py $delays_dir "$final_root_dir"/final_mcdonalds_distributions.pdf "GE*_delays.root" "_intCorrectionApplied_gbtCorrectionApplied"
-    echo
+if [[ "$CHECK_INITIAL_ONLY" -eq 1 ]]; then
+    render_args+=(--check_initial)
 fi
 
-python3 checking_scripts/check_means_canvases.py $final_root_dir "$final_root_dir"/check_means_final.pdf "finalFitInformation*.root" 
+python3 checking_scripts/render_checks.py "${render_args[@]}"
 echo
-python3 checking_scripts/check_means_canvases.py $initial_root_dir "$initial_root_dir"/check_means_initial.pdf "fitInformation*.root"
-echo
-python3 checking_scripts/check_means_canvases.py $initial_root_dir "$initial_root_dir"/check_sigmas_initial.pdf "fitInformation*.root" "fit_sigmas_hist" [0,10] 
-echo
-python3 checking_scripts/check_means_canvases.py $initial_root_dir "$initial_root_dir"/check_amplitudes_initial.pdf "fitInformation*.root" "fit_amplitudes_hist" [0,500]
-echo
-python3 checking_scripts/check_means_canvases.py $initial_root_dir "$initial_root_dir"/check_backgrounds_initial.pdf "fitInformation*.root" "fit_backgrounds_hist" [0,500]
-echo
-
-#echo "Processing all ROOT files in $root_dir completed."
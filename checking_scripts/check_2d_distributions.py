@@ -9,6 +9,7 @@ import os
 import sys
 import glob
 import signal
+import tempfile
 import shutil
 
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
@@ -18,73 +19,60 @@ def hists_2d_to_pdf(directory, output_pdf_path, file_string="GE*_delays.root", h
     # Open the ROOT file
     #root_file = ROOT.TFile.Open(root_file_path)
 
-    # Create a temporary directory to store images
-    temp_dir = "./temp_canvas_images"
-    if os.path.exists(temp_dir):
-       shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir, exist_ok=True)
-
-    # List to store image paths
-    image_paths = []
-    images = []
-
-    #for i, file in enumerate(os.listdir(directory+"/"+file_string)): 
-    for i, file in enumerate(glob.glob(directory+"/"+file_string)):
-        root_file = ROOT.TFile.Open(file)
-        #canvas = ROOT.TCanvas("canvas", "My Canvas", 800, 600)
-        #print(root_file)
-        keys = root_file.GetListOfKeys()
-        if len(keys)==0:
-            continue
-
-        if file_string!="GE*_delays.root":
-            key_name_search = file.split("/")[-1].replace(".root","")+hist_string
-        else:
-            key_name_search = file.split("/")[-1].replace("_delays.root","")+hist_string
-
-        for key in keys:
-            name = key.GetName()
-            if name == key_name_search:
-                data_key = name
+    # Create a temporary directory to store images (one of its own, so several checks can run at the same time)
+    temp_dir = tempfile.mkdtemp(prefix="temp_canvas_images_")
+    try:
+        # List to store image paths
+        image_paths = []
+        images = []
+
+        #for i, file in enumerate(os.listdir(directory+"/"+file_string)): 
+        for i, file in enumerate(glob.glob(directory+"/"+file_string)):
+            root_file = ROOT.TFile.Open(file)
+            #canvas = ROOT.TCanvas("canvas", "My Canvas", 800, 600)
+            #print(root_file)
+            keys = root_file.GetListOfKeys()
+            if len(keys)==0:
+                continue
+
+            if file_string!="GE*_delays.root":
+                key_name_search = file.split("/")[-1].replace(".root","")+hist_string
+            else:
+                key_name_search = file.split("/")[-1].replace("_delays.root","")+hist_string
+
+            for key in keys:
+                name = key.GetName()
+                if name == key_name_search:
+                    data_key = name
         
-        hist = root_file.Get(data_key)
-        hist.RebinY(120)
-        print(hist)
-
-        canvas = ROOT.TCanvas("canvas", "My Canvas", 800, 600)
-        hist.GetYaxis().SetRangeUser(4,13)
-        hist.Draw("COLZ")
-        hist.SetTitle(file.split("/")[-1].replace(".root",""))
-        image_path = os.path.join(temp_dir, f"fit_2d_hist{i}.png")
-        image_paths.append(image_path)
-        canvas.SaveAs(image_path)
-        root_file.Close()
-
-    for image_path in image_paths:
-        images.append(Image.open(image_path))
-
-    if images:
-        images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
-
-    print("PDF Output", output_pdf_path)
-
-    # Clean up temporary images
-    for image_path in image_paths:
-        os.remove(image_path)
-    os.rmdir(temp_dir)
+            hist = root_file.Get(data_key)
+            hist.RebinY(120)
+            print(hist)
+
+            canvas = ROOT.TCanvas("canvas", "My Canvas", 800, 600)
+            hist.GetYaxis().SetRangeUser(4,13)
+            hist.Draw("COLZ")
+            hist.SetTitle(file.split("/")[-1].replace(".root",""))
+            image_path = os.path.join(temp_dir, f"fit_2d_hist{i}.png")
+            image_paths.append(image_path)
+            canvas.SaveAs(image_path)
+            root_file.Close()
+
+        for image_path in image_paths:
+            images.append(Image.open(image_path))
+
+        if images:
+            images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
+
+        print("PDF Output", output_pdf_path)
+    finally:
+        # Clean up temporary images
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 def cleanup_and_exit(signum, frame):
     print(f"Received signal {signum}. Cleaning up before exit.")
-    os.system('rm -r ./temp_canvas_images')
-
-    # Get the parent process ID (Bash process)
-    parent_pid = os.getppid()
-    
-    # Send SIGTERM to the parent process (Bash script)
-    print(f"Killing parent process {parent_pid}")
-    os.kill(parent_pid, signal.SIGTERM)
-
-    sys.exit(0)
+    # Exiting runs the finally blocks, which remove the temporary images
+    sys.exit(128+signum)
 
 
 signal.signal(signal.SIGINT, cleanup_and_exit)
@@ -2,6 +2,9 @@
 #Argument 0 is the root_file_path
 #Argument 1 is the output_pdf_path
 #Argument 2 is optional and gives the canvas string to search for within the root file
+#--bins is optional and only renders the given x bins (pad groups), e.g. --bins 3,17,42
+#The fit information files from run.py keep the fitted histogram and parameters, and the canvases are drawn here;
+#older files with stored canvases are still read as they are
 
 import ROOT
 from PIL import Image
@@ -9,72 +12,89 @@ import os
 import shutil
 import sys
 import signal
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from delayClasses import fitFileRenderer
 
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
 ROOT.gStyle.SetOptFit(1111)
 
-def canvases_to_pdf(root_file_path, output_pdf_path, canvas_string="fit_canvas"):
+def canvases_to_pdf(root_file_path, output_pdf_path, canvas_string="fit_canvas", bins=None):
     # Open the ROOT file
     root_file = ROOT.TFile.Open(root_file_path)
 
-    # Create a temporary directory to store images
-    temp_dir = "./temp_canvas_images"
-    if os.path.exists(temp_dir):
-       shutil.rmtree(temp_dir) 
-    os.makedirs(temp_dir, exist_ok=True)
-
-    # List to store image paths
-    image_paths = []
-    images = []
-
-    # Loop over keys in the ROOT file to find canvases
-    for key in root_file.GetListOfKeys():
-        if key.GetName().startswith(canvas_string):
-            canvas_name = key.GetName()
-            canvas = root_file.Get(canvas_name)
-            canvas.Draw()
-            image_path = os.path.join(temp_dir, f"{canvas_name}.png")
-            image_paths.append(image_path)
-            canvas.SaveAs(image_path)  # Save canvas as PNG image
-
-    # Close the ROOT file
-    root_file.Close()
-
-    # Combine images into a single PDF
-    for image_path in image_paths:
-        images.append(Image.open(image_path))
-
-    if images:
-        images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
-
-    # Clean up temporary images
-    for image_path in image_paths:
-        os.remove(image_path)
-    os.rmdir(temp_dir)
+    # Create a temporary directory to store images (one of its own, so several checks can run at the same time)
+    temp_dir = tempfile.mkdtemp(prefix="temp_canvas_images_")
+    try:
+        # List to store image paths
+        image_paths = []
+        images = []
+
+        if root_file.GetListOfKeys().Contains("fit_input_hist"):
+            # Draw the fits from the stored histogram and parameters
+            renderer = fitFileRenderer(root_file)
+            canvas = ROOT.TCanvas("canvas", "Fits", 800, 600)
+            if bins is None:
+                bins = range(1, renderer.nbins()+1)
+
+            for binx in bins:
+                if not renderer.render_fit_canvas(binx, canvas):
+                    continue
+                image_path = os.path.join(temp_dir, f"{canvas_string}_bin_{binx}.png")
+                image_paths.append(image_path)
+                canvas.SaveAs(image_path)  # Save canvas as PNG image
+                renderer.clear()
+
+        else:
+            # Loop over keys in the ROOT file to find canvases
+            for key in root_file.GetListOfKeys():
+                if key.GetName().startswith(canvas_string):
+                    canvas_name = key.GetName()
+                    if bins is not None and int(canvas_name.split("_")[-1]) not in bins:
+                        continue
+                    canvas = root_file.Get(canvas_name)
+                    canvas.Draw()
+                    image_path = os.path.join(temp_dir, f"{canvas_name}.png")
+                    image_paths.append(image_path)
+                    canvas.SaveAs(image_path)  # Save canvas as PNG image
+
+        # Close the ROOT file
+        root_file.Close()
+
+        # Combine images into a single PDF
+        for image_path in image_paths:
+            images.append(Image.open(image_path))
+
+        if images:
+            images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
+    finally:
+        # Clean up temporary images
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 def cleanup_and_exit(signum, frame):
     print(f"Received signal {signum}. Cleaning up before exit.")
-    os.system('rm -r ./temp_canvas_images')
-
-    # Get the parent process ID (Bash process)
-    parent_pid = os.getppid()
-
-    # Send SIGTERM to the parent process (Bash script)
-    print(f"Killing parent process {parent_pid}")
-    os.kill(parent_pid, signal.SIGTERM)
-
-    sys.exit(0)
+    # Exiting runs the finally blocks, which remove the temporary images
+    sys.exit(128+signum)
 
 
 signal.signal(signal.SIGINT, cleanup_and_exit)
 signal.signal(signal.SIGTERM, cleanup_and_exit)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root_file_path', type=str, help='Fit information .root file')
+    parser.add_argument('output_pdf_path', type=str, help='Output pdf')
+    parser.add_argument('canvas_string', type=str, nargs='?', default="fit_canvas", help='Canvas name prefix (for files with stored canvases)')
+    parser.add_argument('--bins', type=str, default=None, help='Comma separated x bins to render (default: all)')
+    return parser.parse_args()
+
 if __name__ == "__main__":
     # Usage
-    if len(sys.argv)==3:
-        canvases_to_pdf(sys.argv[1], sys.argv[2])
-    elif len(sys.argv)==4:
-        canvases_to_pdf(sys.argv[1], sys.argv[2], canvas_string=sys.argv[3])
+    args = parse_args()
+    bins = None if args.bins is None else [int(b) for b in args.bins.split(",")]
+    canvases_to_pdf(args.root_file_path, args.output_pdf_path, canvas_string=args.canvas_string, bins=bins)
 
-    print("PDF output: ", sys.argv[2])
+    print("PDF output: ", args.output_pdf_path)
@@ -9,6 +9,7 @@ import os
 import shutil
 import sys
 import signal
+import tempfile
 
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
 ROOT.gStyle.SetOptFit(1111)
@@ -17,72 +18,59 @@ def canvases_to_pdf(root_file_path, output_pdf_path, canvas_string="fit_canvas")
     # Open the ROOT file
     root_file = ROOT.TFile.Open(root_file_path)
 
-    # Create a temporary directory to store images
-    temp_dir = "./temp_canvas_images"
-    if os.path.exists(temp_dir):
-       shutil.rmtree(temp_dir) 
-    os.makedirs(temp_dir, exist_ok=True)
-
-    # List to store image paths
-    image_paths = []
-    images = []
-
-
-    # Loop over keys in the ROOT file to find canvases
-    '''for key in root_file.GetListOfKeys():
-        if key.GetName().startswith(canvas_string):
-            canvas_name = key.GetName()
-            canvas = root_file.Get(canvas_name)
-            canvas1.cd()
-            canvas.Draw()
-
-            image_path = os.path.join(temp_dir, f"{canvas_name}.png")
-            image_paths.append(image_path)
-            #canvas.SaveAs(image_path)  # Save canvas as PNG image
-            canvas1.SaveAs(image_path)'''
-
-    canvas = ROOT.TCanvas("canvas", "", 800, 600)
-
-    # Loop over keys in the ROOT file to find histograms
-    for key in root_file.GetListOfKeys():
-        obj = key.ReadObj()
-        if obj.InheritsFrom("TH1") and key.GetName().startswith(canvas_string):
-            hist_name = key.GetName()
-
-            canvas.cd()
-            obj.RebinX(120)
-            obj.Draw()
-            image_path = os.path.join(temp_dir, f"{hist_name}.png")
-            canvas.SaveAs(image_path)
-            image_paths.append(image_path)
-
-    # Close the ROOT file
-    root_file.Close()
-
-    # Combine images into a single PDF
-    for image_path in image_paths:
-        images.append(Image.open(image_path))
-
-    if images:
-        images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
-
-    # Clean up temporary images
-    for image_path in image_paths:
-        os.remove(image_path)
-    os.rmdir(temp_dir)
+    # Create a temporary directory to store images (one of its own, so several checks can run at the same time)
+    temp_dir = tempfile.mkdtemp(prefix="temp_canvas_images_")
+    try:
+        # List to store image paths
+        image_paths = []
+        images = []
+
+
+        # Loop over keys in the ROOT file to find canvases
+        '''for key in root_file.GetListOfKeys():
+            if key.GetName().startswith(canvas_string):
+                canvas_name = key.GetName()
+                canvas = root_file.Get(canvas_name)
+                canvas1.cd()
+                canvas.Draw()
+
+                image_path = os.path.join(temp_dir, f"{canvas_name}.png")
+                image_paths.append(image_path)
+                #canvas.SaveAs(image_path)  # Save canvas as PNG image
+                canvas1.SaveAs(image_path)'''
+
+        canvas = ROOT.TCanvas("canvas", "", 800, 600)
+
+        # Loop over keys in the ROOT file to find histograms
+        for key in root_file.GetListOfKeys():
+            obj = key.ReadObj()
+            if obj.InheritsFrom("TH1") and key.GetName().startswith(canvas_string):
+                hist_name = key.GetName()
+
+                canvas.cd()
+                obj.RebinX(120)
+                obj.Draw()
+                image_path = os.path.join(temp_dir, f"{hist_name}.png")
+                canvas.SaveAs(image_path)
+                image_paths.append(image_path)
+
+        # Close the ROOT file
+        root_file.Close()
+
+        # Combine images into a single PDF
+        for image_path in image_paths:
+            images.append(Image.open(image_path))
+
+        if images:
+            images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
+    finally:
+        # Clean up temporary images
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 def cleanup_and_exit(signum, frame):
     print(f"Received signal {signum}. Cleaning up before exit.")
-    os.system('rm -r ./temp_canvas_images')
-
-    # Get the parent process ID (Bash process)
-    parent_pid = os.getppid()
-
-    # Send SIGTERM to the parent process (Bash script)
-    print(f"Killing parent process {parent_pid}")
-    os.kill(parent_pid, signal.SIGTERM)
-
-    sys.exit(0)
+    # Exiting runs the finally blocks, which remove the temporary images
+    sys.exit(128+signum)
 
 
 signal.signal(signal.SIGINT, cleanup_and_exit)
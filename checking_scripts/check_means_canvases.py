@@ -9,6 +9,7 @@ import os
 import sys
 import glob
 import signal
+import tempfile
 import shutil 
 
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
@@ -21,59 +22,46 @@ def means_hists_to_pdf(directory, output_pdf_path, file_string="finalFitInformat
         split_values = cleaned.split(',')
         range=split_values
 
-    # Create a temporary directory to store images
-    temp_dir = "./temp_canvas_images"
-    if os.path.exists(temp_dir):
-       shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir, exist_ok=True)
+    # Create a temporary directory to store images (one of its own, so several checks can run at the same time)
+    temp_dir = tempfile.mkdtemp(prefix="temp_canvas_images_")
+    try:
+        # List to store image paths
+        image_paths = []
+        images = []
 
-    # List to store image paths
-    image_paths = []
-    images = []
-
-    #for i, file in enumerate(os.listdir(directory+"/"+file_string)): 
-    for i, file in enumerate(glob.glob(directory+"/"+file_string)):
-        root_file = ROOT.TFile.Open(file)
+        #for i, file in enumerate(os.listdir(directory+"/"+file_string)): 
+        for i, file in enumerate(glob.glob(directory+"/"+file_string)):
+            root_file = ROOT.TFile.Open(file)
         
-        hist = root_file.Get(hist_string)
-        print(hist)
-        canvas = ROOT.TCanvas(f"{file.replace('.root','')}_canvas", "My Canvas", 800, 600)
-        if range is None:
-            hist.GetYaxis().SetRangeUser(4,13)
-        else:
-            hist.GetYaxis().SetRangeUser(float(range[0]),float(range[1]))
-        hist.Draw()
-        hist.SetTitle(file.split("/")[-1].replace(".root",""))
-        image_path = os.path.join(temp_dir, f"{hist_string}{i}.png")
-        image_paths.append(image_path)
-        canvas.SaveAs(image_path)
-        root_file.Close()
-
-    for image_path in image_paths:
-        images.append(Image.open(image_path))
-
-    if images:
-        images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
-
-    print("PDF Output: ", output_pdf_path)
-
-    # Clean up temporary images
-    for image_path in image_paths:
-        os.remove(image_path)
-    os.rmdir(temp_dir)
+            hist = root_file.Get(hist_string)
+            print(hist)
+            canvas = ROOT.TCanvas(f"{file.replace('.root','')}_canvas", "My Canvas", 800, 600)
+            if range is None:
+                hist.GetYaxis().SetRangeUser(4,13)
+            else:
+                hist.GetYaxis().SetRangeUser(float(range[0]),float(range[1]))
+            hist.Draw()
+            hist.SetTitle(file.split("/")[-1].replace(".root",""))
+            image_path = os.path.join(temp_dir, f"{hist_string}{i}.png")
+            image_paths.append(image_path)
+            canvas.SaveAs(image_path)
+            root_file.Close()
+
+        for image_path in image_paths:
+            images.append(Image.open(image_path))
+
+        if images:
+            images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
+
+        print("PDF Output: ", output_pdf_path)
+    finally:
+        # Clean up temporary images
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 def cleanup_and_exit(signum, frame):
     print(f"Received signal {signum}. Cleaning up before exit.")
-    os.system('rm -r ./temp_canvas_images')
-
-    # Get the parent process ID (Bash process)
-    parent_pid = os.getppid()
-    
-    # Send SIGTERM to the parent process (Bash script)
-    print(f"Killing parent process {parent_pid}")
-    os.kill(parent_pid, signal.SIGTERM)
-
-    sys.exit(0)
+    # Exiting runs the finally blocks, which remove the temporary images
+    sys.exit(128+signum)
 
 
 signal.signal(signal.SIGINT, cleanup_and_exit)
@@ -0,0 +1,306 @@
+#Renders all the verification pdfs of check_delay_plots.sh.
+#Every ROOT file is opened once and the pages are printed straight into multi-page pdfs (no png images in between).
+#With -j, the pdfs are rendered by a pool of worker processes, one pdf per task, so the fit files of a run are rendered concurrently.
+#A task whose worker fails (e.g. a worker killed for running out of memory) is rendered again in the main process.
+#Usage: python3 checking_scripts/render_checks.py -r [run number] [-v] [--check_initial] [-j number of processes]
+#Code by Jacob Steenis, 2024/2025
+
+import ROOT
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from delayClasses import fitFileRenderer
+from mcdonaldsStore import mcdonaldsStore, store_exists
+from runMetrics import runMetrics, stageTimes, progressLine, peak_rss_mb
+
+ROOT.gROOT.SetBatch(ROOT.kTRUE)
+ROOT.gStyle.SetOptFit(1111)
+ROOT.gErrorIgnoreLevel = ROOT.kWarning #No "Info in <TCanvas::Print>" line for every page
+
+# Summary plots of the fit information files: hist name -> (pdf name, y range)
+SUMMARY_HISTS = {
+                    "fit_means_hist": ("check_means", [4,13]),
+                    "fit_sigmas_hist": ("check_sigmas", [0,10]),
+                    "fit_amplitudes_hist": ("check_amplitudes", [0,500]),
+                    "fit_backgrounds_hist": ("check_backgrounds", [0,500])
+                }
+
+#A multi-page pdf written with TCanvas::Print: "file.pdf[" opens it, "file.pdf" adds the current canvas as a page
+#and "file.pdf]" closes it. The file is only opened once there is a first page, so nothing is written for no pages.
+#The pages go to a scratch directory of its own under scratch_root (made and removed by render_checks, so the scratch of
+#a worker that dies is removed as well) and the finished pdf is moved into place on close, so renders running at the
+#same time never share files and an interrupted render leaves no half-written pdf.
+scratch_root = None
+
+class pdfBook():
+    def __init__(self, output_pdf_path):
+        self.output_pdf_path = output_pdf_path
+        self.pages = 0
+        self.canvas = None
+        self.scratch_dir = None
+        self.scratch_pdf_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def add_page(self, canvas):
+        if self.pages == 0:
+            self.scratch_dir = tempfile.mkdtemp(prefix="render_", dir=scratch_root)
+            self.scratch_pdf_path = os.path.join(self.scratch_dir, os.path.basename(self.output_pdf_path))
+            canvas.Print(self.scratch_pdf_path+"[")
+        canvas.Print(self.scratch_pdf_path)
+        self.canvas = canvas
+        self.pages += 1
+
+    def close(self):
+        if self.pages > 0:
+            self.canvas.Print(self.scratch_pdf_path+"]")
+            #The scratch can be on another file system, so the pdf is copied next to the output first
+            partial_pdf_path = self.output_pdf_path+".part"
+            try:
+                shutil.copyfile(self.scratch_pdf_path, partial_pdf_path)
+                os.replace(partial_pdf_path, self.output_pdf_path)
+            finally:
+                if os.path.exists(partial_pdf_path):
+                    os.remove(partial_pdf_path)
+            self.discard()
+            print("PDF output: ", self.output_pdf_path)
+
+    def discard(self):
+        if self.scratch_dir is not None:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
+
+# The individual group fits of one fit information file (what check_canvases.py makes)
+def render_fit_pages(root_file_path, output_pdf_path, bins=None, canvas_string="fit_canvas"):
+    print("Processing file: ", root_file_path)
+    root_file = ROOT.TFile.Open(root_file_path)
+
+    with pdfBook(output_pdf_path) as book:
+        if root_file.GetListOfKeys().Contains("fit_input_hist"):
+            renderer = fitFileRenderer(root_file)
+            canvas = ROOT.TCanvas("canvas", "Fits", 800, 600)
+            if bins is None:
+                bins = range(1, renderer.nbins()+1)
+
+            for binx in bins:
+                if not renderer.render_fit_canvas(binx, canvas):
+                    continue
+                book.add_page(canvas)
+                renderer.clear()
+
+        else:
+            # Older files with the canvases stored in them
+            for key in root_file.GetListOfKeys():
+                if key.GetName().startswith(canvas_string):
+                    if bins is not None and int(key.GetName().split("_")[-1]) not in bins:
+                        continue
+                    canvas = root_file.Get(key.GetName())
+                    canvas.Draw()
+                    book.add_page(canvas)
+
+    root_file.Close()
+    return book.pages
+
+# The McDonalds plots of all chambers, one page each (what check_2d_distributions.py makes).
+# histos yields (page title, TH2) pairs.
+def render_2d_pages(histos, output_pdf_path):
+    canvas = ROOT.TCanvas("canvas", "My Canvas", 800, 600)
+    with pdfBook(output_pdf_path) as book:
+        for title, hist in histos:
+            canvas.cd()
+            hist.RebinY(120)
+            hist.GetYaxis().SetRangeUser(4,13)
+            hist.Draw("COLZ")
+            hist.SetTitle(title)
+            book.add_page(canvas)
+    return book.pages
+
+# The generators above cannot be sent to a worker process, so the tasks name the directories instead
+def render_delays_2d_pages(delays_dir, output_pdf_path, hist_string=""):
+    return render_2d_pages(delays_2d_histos(delays_dir, hist_string), output_pdf_path)
+
+def render_mcdonalds_2d_pages(mcdonalds_dir, output_pdf_path):
+    return render_2d_pages(mcdonalds_2d_histos(mcdonalds_dir), output_pdf_path)
+
+def delays_2d_histos(delays_dir, hist_string=""):
+    for file in sorted(glob.glob(delays_dir+"/GE*_delays.root")):
+        root_file = ROOT.TFile.Open(file)
+        hist = root_file.Get(file.split("/")[-1].replace("_delays.root","")+hist_string)
+        if hist:
+            hist.SetDirectory(0)
+            yield file.split("/")[-1].replace(".root",""), hist
+        root_file.Close()
+
+def mcdonalds_2d_histos(mcdonalds_dir):
+    if store_exists(mcdonalds_dir):
+        store = mcdonaldsStore(mcdonalds_dir)
+        for name in store.chamber_names():
+            yield name, store.to_hist(name)
+        return
+
+    for file in sorted(glob.glob(mcdonalds_dir+"/GE*.root")):
+        root_file = ROOT.TFile.Open(file)
+        if len(root_file.GetListOfKeys()) > 0:
+            name = file.split("/")[-1].replace(".root","")
+            hist = root_file.Get(name)
+            hist.SetDirectory(0)
+            yield name, hist
+        root_file.Close()
+
+# One page per fit information file in each of the summary pdfs (what check_means_canvases.py makes),
+# reading every file only once for all the summary hists
+def render_summary_pages(root_files, output_dir, label, hist_strings=SUMMARY_HISTS):
+    books = {hist_string: pdfBook(f"{output_dir}/{pdf_name}_{label}.pdf") for hist_string, (pdf_name, _) in hist_strings.items()}
+    canvas = ROOT.TCanvas("canvas", "My Canvas", 800, 600)
+
+    try:
+        for file in root_files:
+            root_file = ROOT.TFile.Open(file)
+            for hist_string, (pdf_name, y_range) in hist_strings.items():
+                hist = root_file.Get(hist_string)
+                if not hist:
+                    continue
+                canvas.cd()
+                hist.GetYaxis().SetRangeUser(*y_range)
+                hist.Draw()
+                hist.SetTitle(file.split("/")[-1].replace(".root",""))
+                books[hist_string].add_page(canvas)
+            root_file.Close()
+    except BaseException:
+        for book in books.values():
+            book.discard()
+        raise
+
+    for book in books.values():
+        book.close()
+    return sum(book.pages for book in books.values())
+
+# Every task writes its own pdf(s), so the pages of each pdf are in the same (sorted) order however many processes run them
+def render_tasks(run_subfolder, verbose=False, check_initial_only=False):
+    initial_root_dir = f"GEM_delays/{run_subfolder}/verification_plots/initial"
+    final_root_dir = f"GEM_delays/{run_subfolder}/verification_plots/final"
+    delays_dir = f"GEM_delays/{run_subfolder}/delays"
+    mcdonalds_dir = f"GEM_mcdonalds_data/{run_subfolder}"
+
+    if check_initial_only:
+        return [(render_mcdonalds_2d_pages, (mcdonalds_dir, f"{mcdonalds_dir}/initial_mcdonalds_distributions.pdf"))]
+
+    final_files = sorted(glob.glob(f"{final_root_dir}/finalFitInformation*.root"))
+    initial_files = sorted(glob.glob(f"{initial_root_dir}/fitInformation*.root"))
+
+    # The summaries go first: each is a single long task that reads every fit information file
+    tasks = [
+                (render_summary_pages, (initial_files, initial_root_dir, "initial")),
+                (render_summary_pages, (final_files, final_root_dir, "final", {"fit_means_hist": SUMMARY_HISTS["fit_means_hist"]}))
+            ]
+
+    #For the verbose case, we output the individual canvas pdfs and the initial 2d distributions
+    if verbose:
+        tasks += [
+                    (render_delays_2d_pages, (delays_dir, f"{initial_root_dir}/initial_mcdonalds_distributions.pdf")),
+                    (render_delays_2d_pages, (delays_dir, f"{final_root_dir}/final_mcdonalds_distributions.pdf", "_intCorrectionApplied_gbtCorrectionApplied"))
+                ]
+        tasks += [(render_fit_pages, (root_file, root_file.replace(".root", "_check.pdf"))) for root_file in final_files + initial_files]
+
+    return tasks
+
+# Runs one task and returns its metrics record
+def _run_task(function, args, task_scratch_root=None):
+    global scratch_root
+    scratch_root = task_scratch_root
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+    times = stageTimes()
+    with times.stage(function.__name__):
+        pages = function(*args)
+    return {"task": function.__name__, "input": task_input(args), "output": args[1], "pages": pages, "stages": times.stages, "peak_rss_mb": peak_rss_mb()}
+
+def task_input(args):
+    return args[0] if isinstance(args[0], str) else f"{len(args[0])} files"
+
+#Returns the number of tasks that failed (also when rendered again in the main process)
+def render_checks(run_subfolder, verbose=False, check_initial_only=False, jobs=1):
+    if check_initial_only:
+        print("\nRunning only initial 2D distribution check...")
+    elif verbose:
+        print("\nVerbose mode is ON. Outputting the 2d initial data and the individual canvas fits\n")
+
+    tasks = render_tasks(run_subfolder, verbose=verbose, check_initial_only=check_initial_only)
+    #More workers than cores (or tasks) only add memory
+    jobs = max(1, min(jobs, os.cpu_count() or 1, len(tasks)))
+
+    # Rendering time per kind of pdf and a record per pdf
+    metrics_dir = f"GEM_mcdonalds_data/{run_subfolder}" if check_initial_only else f"GEM_delays/{run_subfolder}"
+    metrics = runMetrics(f"{metrics_dir}/render_metrics.jsonl", step="render_checks", run=run_subfolder, jobs=jobs, verbose=verbose)
+    progress = progressLine(len(tasks), unit="pdfs", min_interval=0, redraw=False)
+
+    def task_done(record):
+        metrics.times.merge(record["stages"])
+        metrics.record("pdf", **record)
+        metrics.count("pages", record["pages"] or 0)
+        progress.update(progress.done+1)
+
+    def task_failed(function, args, error):
+        print(f"\033[91mRendering {args[1]} failed: {error!r}\033[0m")
+        metrics.record("failed", task=function.__name__, input=task_input(args), output=args[1], error=repr(error))
+        metrics.count("failed")
+
+    task_scratch_root = tempfile.mkdtemp(prefix="render_checks_")
+    try:
+        retry = tasks
+        if jobs > 1:
+            retry = []
+            #Spawned workers start from a fresh interpreter instead of a fork of this process's ROOT state
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [pool.submit(_run_task, function, args, task_scratch_root) for function, args in tasks]
+                for (function, args), future in zip(tasks, futures):
+                    try:
+                        task_done(future.result())
+                    except Exception as error:
+                        #A dead worker breaks the pool and fails every unfinished task, so these are rendered again below
+                        print(f"\033[93mRendering {args[1]} in a worker failed ({error!r}); rendering it again in the main process\033[0m")
+                        retry.append((function, args))
+
+        for function, args in retry:
+            try:
+                task_done(_run_task(function, args, task_scratch_root))
+            except Exception as error:
+                task_failed(function, args, error)
+    finally:
+        shutil.rmtree(task_scratch_root, ignore_errors=True)
+
+    failed = metrics.counters.get("failed", 0)
+    metrics.close(pages_per_second=metrics.counters.get("pages", 0)/metrics.elapsed(), failed=failed)
+    return failed
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', type=int, default=None, help='Run number to check')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Also render every individual group fit and the 2d distributions')
+    parser.add_argument('--check_initial', action='store_true', help='Only render the initial McDonalds plots')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes rendering pdfs at the same time (at most the number of cores). Every pdf is one task, so this mostly helps with -v, where the fit pages of every chamber are a pdf of their own; without -v there are only the two summary tasks')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.run is not None:
+        run_subfolder = f"run{args.run}"
+    else:
+        print("YOU ARE RUNNING THE DEFAULT VERSION. IT'S BEST TO INSTEAD SPECIFY A RUN NUMBER WITH -r")
+        run_subfolder = "default"
+
+    if render_checks(run_subfolder, verbose=args.verbose, check_initial_only=args.check_initial, jobs=args.jobs) > 0:
+        sys.exit(1)
@@ -9,10 +9,69 @@ import os
 import re
 import ROOT
 import statistics
+import json
+import hashlib
+import functools
+import collections
+import time
+from batchFitter import fit_gaus_pol0, CONVERGED
+
+FIT_BACKENDS = ("root", "numpy")
+OPTIMIZERS = ("refit", "analytic")
+FIT_MODEL = "gaus(0)+pol0(3); p0 in [0.8, 1.2]*max, p1 in [0.3, 1.7]*mean, p2 in [0.1, 4], p3 in [0, 100]"
+FIT_CACHE_VERSION = 2 #Increase when the fitting itself changes, so older cached results are not reused
+
+# Same detector layout as mcdonaldsClasses
+stations = [1, 2]
+layers = [1, 2]
+regions = [-1, 1]
+chambers = range(1,36+1)
+N_PADS = 1536
+
+GBT_VFATS = {
+                0: [7,12,13,14,15,23], 
+                1: [0,1,2,3,4,5,6,8,16], 
+                2: [9,10,11,17,18,19,20,21,22]
+            }
+ELECTRONICS_COLUMNS = ['oh', 'amc', 'fed', 'vfat', 'gbt', 'group', 'group_head', 'gbt_head']
+
+# Electronics coordinates (fed, amc, oh, vfat, gbt, group) of every pad group of every chamber, built once per
+# rebin_num and indexed by (station, region, chamber, layer, x bin of the rebinned McDonalds plot).
+# group_head/gbt_head flag the first pad group of every fed/amc/oh/vfat/group and fed/amc/oh/gbt.
+@functools.lru_cache(maxsize=None)
+def electronics_table(rebin_num):
+    n_bins = N_PADS//rebin_num
+    station, region, chamber, layer, bins = (
+        grid.ravel() for grid in np.meshgrid(stations, regions, list(chambers), layers, np.arange(1, n_bins+1), indexing="ij")
+    )
+    #Bin centers of the rebinned x axis: RebinX keeps every bin rebin_num pads wide and drops the leftover pads at the top
+    padID = -0.5 + (bins - 0.5)*rebin_num
+
+    vfat = np.trunc(padID/192).astype(np.int64) + 8*np.trunc((padID%192)/64).astype(np.int64)
+    gbt_of_vfat = np.full(24, -9999999999, dtype=np.int64)
+    for gbt, vfats in GBT_VFATS.items():
+        gbt_of_vfat[vfats] = gbt
+
+    table = pd.DataFrame({
+                "station": station, 
+                "region": region, 
+                "chamber": chamber, 
+                "layer": layer, 
+                "bin": bins, 
+                "oh": 2*((chamber-1)%6) + (layer==2), 
+                "amc": 2*((chamber-1)//6) + 1, 
+                "fed": np.where(region<0, 1467, 1468), 
+                "vfat": vfat, 
+                "gbt": gbt_of_vfat[np.clip(vfat, 0, 23)], 
+                "group": np.trunc(padID/rebin_num).astype(np.int64)%8
+            })
+    table["group_head"] = ~table.duplicated(subset=['fed', 'amc', 'oh', 'station', 'chamber', 'layer', 'vfat', 'group'])
+    table["gbt_head"] = ~table.duplicated(subset=['fed', 'amc', 'oh', 'station', 'chamber', 'layer', 'gbt'])
+    return table.set_index(["station", "region", "chamber", "layer", "bin"]).sort_index()
 
 #This is initialized at the chamber level. Every chamber will have to re-initialize this class.
 class delayGenerator():
-    def __init__(self, histo, histo_name, filename, reference_point=9, rebin_num=8, num_optimize_steps=5, SPECIFY_RUN=False):
+    def __init__(self, histo, histo_name, filename, reference_point=9, rebin_num=8, num_optimize_steps=5, SPECIFY_RUN=False, fit_backend="root", write_intermediate=False, optimizer="refit", fit_cache=None):
         if histo==None or histo_name==None:
             self.status = False
         
@@ -30,7 +89,7 @@ class delayGenerator():
                 self.baseName = "GEM_delays/default"
 
             #Getting parameters
-            self.general = generalFunctions()
+            self.general = generalFunctions(fit_cache=fit_cache)
             self.histo, self.hotChannels = self.hotPadRemover(histo) #Input histo
             self.histo_name = histo_name #Input histo name
             self.filename = filename
@@ -38,6 +97,9 @@ class delayGenerator():
             #self.init_reference_point = init_reference_point
             self.rebin_num = rebin_num
             self.num_optimize_steps = num_optimize_steps
+            self.fit_backend = fit_backend #"root" (one TF1 fit per pad group) or "numpy" (all groups fitted at once)
+            self.write_intermediate = write_intermediate #Write the fit information of every optimizer step
+            self.optimizer = optimizer #"refit" (fit every candidate) or "analytic" (predict the means from the initial fit)
 
             #To rebin the data into groups!
             self.histo = histo.RebinX(self.rebin_num)
@@ -66,7 +128,8 @@ class delayGenerator():
             self.final_amplitudes, self.final_means, self.final_sigmas, self.final_backgrounds = (
                 self.general.fit_2d_histogram(self.gbt_applied_histo, 
                     output_file=f"{self.baseName}/verification_plots/final/finalFitInformation_"+self.gbt_applied_histo.GetName()+".root",
-                    fit_range=[4,12]
+                    fit_range=[4,12],
+                    backend=self.fit_backend
                 )
             )
             
@@ -98,68 +161,18 @@ class delayGenerator():
         else:
             raise ValueError("Incorrect string format for the input!")
 
-    def calc_oh(self):
-        oh = 2*((self.chamber-1)%6)
-        if self.layer== 2:
-            oh += 1
-        return oh
-
-    def calc_amc(self):
-        amc = 2*int((self.chamber-1)/6.0) + 1
-        return amc
-
-    def calc_ifed(self):
-        if self.region<0:
-            return 1467
-        elif self.region>0:
-            return 1468
-        else:
-            raise ValueError("Somehow you got a station of 0 :(")
-
-    def calc_vfat(self, df):
-        vfat_values = []
-        for padID in df['padID']:
-            eta = int(padID/192)
-            phi = int((padID%192)/64)
-            #vfat = 8*int((padID%24)/192.0)+int(padID/64)
-            vfat = eta+phi*8 
-            vfat_values.append(vfat)
-        return vfat_values
-
-    def calc_gbt(self, df):
-        gbt0 = [7,12,13,14,15,23]
-        gbt1 = [0,1,2,3,4,5,6,8,16]
-        gbt2 = [9,10,11,17,18,19,20,21,22]
-        
-        gbt_values = []
-        
-        for vfat in df['vfat']:
-            if int(vfat) in gbt0:
-                temp_gbt = 0
-            elif int(vfat) in gbt1:
-                temp_gbt = 1
-            elif int(vfat) in gbt2:
-                temp_gbt = 2
-            else:
-                temp_gbt = -9999999999
-            gbt_values.append(temp_gbt)
-            
-        return gbt_values
-            
-    def calc_group(self, df):
-        group_values = []
-        for padID in df['padID']:
-            group = int(padID/self.rebin_num)%8
-            group_values.append(group)
-        return group_values
-    
+    # Electronics coordinates from the precomputed electronics_table, joined on the x bin (pad group) of every row
     def apply_info_to_df(self, df):
-        df['oh'] = self.calc_oh()
-        df['amc'] = self.calc_amc()
-        df['fed'] = self.calc_ifed()
-        df['vfat'] = self.calc_vfat(df)
-        df['gbt'] = self.calc_gbt(df)
-        df['group'] = self.calc_group(df)
+        table = electronics_table(self.rebin_num)
+        try:
+            chamber_table = table.loc[(self.station, self.region, self.chamber, self.layer)]
+        except KeyError:
+            raise ValueError(f"GE{self.station}1 region {self.region} chamber {self.chamber} layer {self.layer} is not in the electronics mapping!")
+
+        bins = np.floor((df['padID'].to_numpy() + 0.5)/self.rebin_num).astype(int) + 1
+        rows = chamber_table.loc[bins]
+        for column in ELECTRONICS_COLUMNS:
+            df[column] = rows[column].to_numpy()
     
     def data_generator(self):   
         all_expanded_difference_hists = {}
@@ -169,7 +182,8 @@ class delayGenerator():
             self.general.fit_2d_histogram(
                 rebinned_hist, 
                 output_file=f"{self.baseName}/verification_plots/initial/fitInformation_"+self.histo_name+".root", 
-                fit_range=[2,10]
+                fit_range=[2,10],
+                backend=self.fit_backend
             )
         )
        
@@ -197,21 +211,8 @@ class delayGenerator():
         )
             
     def applier(self, correction_df, histo, hist_string=""):
-        applied_histo = ROOT.TH2D(histo.GetName()+hist_string, 
-                                    histo.GetName()+hist_string, 
-                                    histo.GetNbinsX(), 
-                                    histo.GetXaxis().GetXmin(), 
-                                    histo.GetXaxis().GetXmax(), 
-                                    histo.GetNbinsY(), 
-                                    histo.GetYaxis().GetXmin(), 
-                                    histo.GetYaxis().GetXmax()
-                                )
-
-        for n in range(1, histo.GetNbinsX()+1):
-            for m in range(1, histo.GetNbinsY()+1):              
-                #print(n, m)
-                applied_histo.SetBinContent(n, m+int(correction_df.iloc[n-1]*120), histo.GetBinContent(n, m))
-        return applied_histo
+        shifts = (correction_df.to_numpy(dtype=float)*120).astype(int)
+        return self.general.shift_hist_columns(histo, shifts, histo.GetName()+hist_string)
     
     def delays_to_int(self, df):
         temp_rounded_values = []
@@ -228,6 +229,11 @@ class delayGenerator():
         return df
     
     def int_optimizer(self):
+        if self.optimizer == "analytic":
+            return self.analytic_int_optimizer()
+        elif self.optimizer != "refit":
+            raise ValueError(f"Unknown optimizer {self.optimizer}; choose one of {OPTIMIZERS}")
+
         all_delays_df_wInt = {}
         all_int_applied_histos = {}
         fit_stdev_values = {} #For storing the individual stdev and mean values
@@ -239,11 +245,16 @@ class delayGenerator():
 
         #Cycle through the different adjustments to the reference number (e.g. +0.2, +0.4, ...)
         for i, corrected_data in enumerate(all_int_applied_histos.items()):
+            intermediate_file = None
+            if self.write_intermediate:
+                intermediate_file = f"{self.baseName}/verification_plots/intermediate/optimizerCheck_{self.histo_name}_{i}.root"
+
             opt_amplitudes_hist, opt_means_hist, opt_sigmas_hist, opt_backgrounds_hist = (
                 self.general.fit_2d_histogram(
                     corrected_data[1], 
-                    output_file=f"{self.baseName}/verification_plots/intermediate/optimizerCheck_{self.histo_name}_{i}.root", 
-                    fit_range=[4,12]
+                    output_file=intermediate_file, 
+                    fit_range=[4,12],
+                    backend=self.fit_backend
                 )
             )
 
@@ -286,6 +297,49 @@ class delayGenerator():
 
         return int_optimized_df, float(min_offset_key) #, overall_adjustment
     
+    # An integer delay shifts a whole group by exactly that many BX, so the group mean after the correction is
+    # predicted as the initial fit mean + the integer delay. Every candidate reference offset is scored with the
+    # standard deviation of these predicted means (same [7,12) window as the refit optimizer) without any new fit,
+    # and only the winner is fitted once to check the prediction.
+    def analytic_int_optimizer(self):
+        all_delays_df_wInt = {}
+        initial_means = self.means_df["mean"].to_numpy()
+        fitted = initial_means != 0
+        stdevs = []
+
+        for key in self.all_df_float.keys():
+            all_delays_df_wInt[key] = self.delays_to_int(self.all_df_float[key])
+            predicted_means = initial_means[fitted] + all_delays_df_wInt[key]["bunchDelay"].to_numpy()[fitted]
+            stdevs.append(self.general.means_spread(predicted_means))
+
+        min_index = np.argmin(stdevs)
+        min_offset_key = list(all_delays_df_wInt.keys())[min_index]
+        print("Predicted standard deviation values from optimization: ", stdevs)
+        print(
+                "Minimum standard deviation reference number: ", 
+                (self.reference_point + float(min_offset_key)), 
+                "bunch crossings \n"
+            )
+
+        # One verification fit of the chosen delays
+        intermediate_file = None
+        if self.write_intermediate:
+            intermediate_file = f"{self.baseName}/verification_plots/intermediate/optimizerCheck_{self.histo_name}_{min_index}.root"
+
+        int_applied_histo = self.applier(all_delays_df_wInt[min_offset_key]['bunchDelay'], self.histo, hist_string="_intApplied"+str(min_offset_key).split(".")[-1])
+        opt_amplitudes_hist, opt_means_hist, opt_sigmas_hist, opt_backgrounds_hist = (
+            self.general.fit_2d_histogram(
+                int_applied_histo, 
+                output_file=intermediate_file, 
+                fit_range=[4,12],
+                backend=self.fit_backend
+            )
+        )
+        verified_means = self.general.hist_to_array(opt_means_hist)[1:opt_means_hist.GetNbinsX()+1]
+        print("Verified standard deviation of the chosen delays: ", self.general.means_spread(verified_means[verified_means != 0]), "\n")
+
+        return all_delays_df_wInt[min_offset_key], float(min_offset_key)
+
     def df_to_hist(self, correction_df, pad_df, histo_string=""):
         differences = ROOT.TH1D(self.histo.GetName()+histo_string, 
                                     self.histo.GetName()+histo_string, 
@@ -299,25 +353,14 @@ class delayGenerator():
         return differences
     
     def calc_gbt_delay(self):
-        gbt = int((self.min_reference_point)*120)
+        gbt = int(round((self.min_reference_point)*120)) #Rounded, since e.g. 31/120*120 is just below 31
         temp_df = self.int_df
         temp_df["gbtDelay"] = gbt
         return temp_df
     
     def gbt_applier(self, correction_df, histo, hist_string=""):
-        applied_histo = ROOT.TH2D(histo.GetName()+hist_string, 
-                                    histo.GetName()+hist_string, 
-                                    histo.GetNbinsX(), 
-                                    histo.GetXaxis().GetXmin(), 
-                                    histo.GetXaxis().GetXmax(), 
-                                    histo.GetNbinsY(), 
-                                    histo.GetYaxis().GetXmin(), 
-                                    histo.GetYaxis().GetXmax())
-
-        for n in range(1, histo.GetNbinsX()+1):
-            for m in range(1, histo.GetNbinsY()+1):               
-                applied_histo.SetBinContent(n, m-int(correction_df.iloc[n-1]*120/120), histo.GetBinContent(n, m))
-        return applied_histo
+        shifts = -(correction_df.to_numpy(dtype=float)*120/120).astype(int)
+        return self.general.shift_hist_columns(histo, shifts, histo.GetName()+hist_string)
     
     def format_histos(self):
         self.histo.GetXaxis().SetTitle("Expaned Pad ID")
@@ -337,78 +380,129 @@ class delayGenerator():
         self.gbt_applied_histo.SetTitle(self.gbt_applied_histo.GetName())
     
     #For reducing the df from being based on padID to being based on group number 
+    #(the first pad group of every fed/amc/oh/vfat/group, flagged in the electronics table)
     def df_reducer_group(self, df):
         temp_df = df.copy()
-        return temp_df.drop_duplicates(subset=['fed', 'amc', 'oh', 'vfat', 'group'])
+        return temp_df[temp_df['group_head']]
     
     #For reducing the df from being based on padID to being based on gbt number
     def df_reducer_gbt(self, df):
         temp_df = df.copy()
-        return temp_df.drop_duplicates(subset=['fed', 'amc', 'oh', 'gbt'])
+        return temp_df[temp_df['gbt_head']]
 
+    # Works on the whole bin-content matrix at once: column totals, the (first) maximum BX bin, the number of
+    # non-zero integer BXs and the ratio test are computed for all pads together, then the hot pads are zeroed.
     def hotPadRemover(self, hist):
         hot_chans = {}
-        for bx in range(1, hist.GetNbinsX()+1):
-            i_max_content = None
-            max_content = 1
-            total_X_content = sum(hist.GetBinContent(bx, by) for by in range(1, hist.GetNbinsY() + 1))
-           
-            if total_X_content < 30:
-                continue
-
-            for by in range(1, hist.GetNbinsY()+1):
-                if hist.GetBinContent(bx, by) > max_content:
-                    max_content = hist.GetBinContent(bx, by)
-                    i_max_content = by
-            
-            if i_max_content is None:
-                continue
-
-
-            all_bxs = range(1, 16)
-            all_bxs_counts = [hist.GetBinContent(bx, hist.GetYaxis().FindBin(check-1)) for check in all_bxs]
-
-            check_bxs = [ch for ch in all_bxs if abs(ch - int(i_max_content/120)-1) > 1]
-            #bx_counts = [hist.GetBinContent(bx, hist.GetYaxis().FindBin(check-1)) for check in check_chans]
-
-            count_nonzero = sum(v != 0 for v in all_bxs_counts)
-
-            '''if bx==505:
-                hist.RebinY(120)
-                print(max_content)
-                for by in range(1, hist.GetNbinsY()+1):
-                    print("BY: ", by, "COUNTS: ", hist.GetBinContent(bx, by))
-                
-                print(check_bxs)
-                break'''
-
-            for i in check_bxs:
-                count = hist.GetBinContent(bx, hist.GetYaxis().FindBin(i-1))
-                if abs(max_content-count)/max_content < 0.5 and count_nonzero > 8:
-                    print(f"THROWING AWAY padID {bx} SINCE IT'S HOT!")
-
-                    if hist.GetName() not in hot_chans.keys():
-                        hot_chans[hist.GetName()] = [bx]
-                    else:
-                        hot_chans[hist.GetName()].append(bx)
+        nx, ny = hist.GetNbinsX(), hist.GetNbinsY()
+        contents = self.general.hist_to_array(hist)
+        body = contents[1:ny+1, 1:nx+1]
+
+        total_X_content = body.sum(axis=0)
+        max_content = body.max(axis=0)
+        i_max_content = body.argmax(axis=0) + 1 #First bin holding the maximum, like the old strict ">" scan
+
+        # Counts at the integer BXs 0..14
+        all_bxs = np.arange(1, 16)
+        all_bxs_counts = contents[[hist.GetYaxis().FindBin(check-1) for check in all_bxs], 1:nx+1]
+        count_nonzero = (all_bxs_counts != 0).sum(axis=0)
+
+        check_bxs = np.abs(all_bxs[:, None] - (i_max_content//120)[None, :] - 1) > 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similar = np.abs(max_content[None, :] - all_bxs_counts)/max_content[None, :] < 0.5
+
+        hot = (
+                (total_X_content >= 30)
+                & (max_content > 1)
+                & (count_nonzero > 8)
+                & (check_bxs & similar).any(axis=0)
+            )
 
-                    for by in range(hist.GetNbinsY()):
-                        hist.SetBinContent(bx, by, 0)
-                        hist.SetBinError(bx, by, 0)
+        hot_bins = np.flatnonzero(hot) + 1
+        if len(hot_bins) == 0:
+            return hist, hot_chans
+
+        for bx in hot_bins.tolist():
+            print(f"THROWING AWAY padID {bx} SINCE IT'S HOT!")
+        hot_chans[hist.GetName()] = hot_bins.tolist()
+
+        # Same bins as before (y bins 0 to ny-1) for both the contents and the errors
+        if hist.GetSumw2N() == 0:
+            hist.Sumw2()
+        errors = self.general.hist_to_array(hist, sumw2=True)
+        contents[0:ny, hot_bins] = 0
+        errors[0:ny, hot_bins] = 0
+        self.general.reset_hist_stats(hist)
+        hist.SetEntries(hist.GetEntries() + len(hot_bins)*ny) #Same entry count as one SetBinContent call per zeroed bin
         return hist, hot_chans
 
 #General functions used in the processing
 class generalFunctions():
-    def __init__(self):
-        pass
+    def __init__(self, fit_cache=None):
+        self.fit_cache = fit_cache #Optional fitCache, so fit_2d_histogram can reuse earlier fit results
+        #Number of fit_2d_histogram calls, fitted groups and cache hits, and the time spent getting the fit results
+        self.fit_stats = {"fits": 0, "fitted_groups": 0, "fit_cache_hits": 0, "fit_seconds": 0.0, "fit_cpu_seconds": 0.0}
+
+    # Zero-copy numpy view of a histogram's bin contents (or sum of squared weights), including the
+    # under/overflow bins. 2d histograms are indexed [ybin, xbin]. Writing to the view changes the histogram.
+    def hist_to_array(self, hist, sumw2=False):
+        dtype = np.float32 if isinstance(hist, ROOT.TArrayF) else np.float64
+        if sumw2:
+            buffer, dtype = hist.GetSumw2().GetArray(), np.float64
+        else:
+            buffer = hist.GetArray()
+
+        array = np.frombuffer(buffer, dtype=dtype, count=hist.GetNcells())
+        if hist.GetDimension() == 2:
+            return array.reshape(hist.GetNbinsY()+2, hist.GetNbinsX()+2)
+        return array
+
+    # After writing bin contents through hist_to_array, makes ROOT recompute the statistics from the bins
+    # (what SetBinContent does for every call)
+    def reset_hist_stats(self, hist):
+        hist.PutStats(np.zeros(13, dtype=np.float64))
+
+    # Makes a new 2d histogram (same binning as the input) where every x bin column is moved up in y by its own
+    # integer number of bins (shifts[xbin-1], negative moves it down). Everything that is shifted past the edges
+    # of the y axis is summed into the underflow/overflow bin of its column, so no content is lost.
+    def shift_hist_columns(self, histo, shifts, hist_name):
+        nx, ny = histo.GetNbinsX(), histo.GetNbinsY()
+        shifted_histo = ROOT.TH2D(hist_name, 
+                                    hist_name, 
+                                    nx, 
+                                    histo.GetXaxis().GetXmin(), 
+                                    histo.GetXaxis().GetXmax(), 
+                                    ny, 
+                                    histo.GetYaxis().GetXmin(), 
+                                    histo.GetYaxis().GetXmax()
+                                )
+
+        shifts = np.asarray(shifts, dtype=np.int64)[:nx]
+        contents = self.hist_to_array(histo)[1:ny+1, 1:nx+1]
+        target_y = np.clip(np.arange(1, ny+1)[:, None] + shifts[None, :], 0, ny+1)
+        target_bins = target_y*(nx+2) + np.arange(1, nx+1)[None, :]
+
+        shifted = self.hist_to_array(shifted_histo)
+        shifted[:] = np.bincount(target_bins.ravel(), weights=contents.ravel(), minlength=shifted.size).reshape(shifted.shape)
+        self.reset_hist_stats(shifted_histo)
+        shifted_histo.SetEntries(float(contents.sum()))
+        return shifted_histo
+
+    # Standard deviation of the group means between 7 and 12 BX, as the tempHist in int_optimizer computes it
+    def means_spread(self, means):
+        means = np.asarray(means, dtype=np.float64)
+        means = means[(means >= 7) & (means < 12)]
+        if len(means) == 0:
+            return 0.0
+        return float(np.std(means))
 
     # Iterates over all x bins in a 2d histogram, 
     # fits them with a gaussian and outputs a root file containing:
     #   1) a histo with the means as a function of x bin
     #   2) a histo with the sigmas as a function of the x bin
-    #   3) canvases with all of the individual fits
+    #   3) the fitted 2d histogram and the fit settings, from which fitFileRenderer draws the individual fits
 
-    def fit_2d_histogram(self, input_hist, output_file=None, fit_range=None, max_straddle=False):
+    def fit_2d_histogram(self, input_hist, output_file=None, fit_range=None, max_straddle=False, backend="root"):
         h2d = input_hist.Clone()
         #h2d.RebinY(120) #Improves the fitting
         ROOT.gROOT.SetBatch(True)
@@ -416,6 +510,9 @@ class generalFunctions():
             print("Warning, you have selected two different fit methods. The first one will be chosen.")
             print("Your options are: Whole histo (default), fit_range, or max_straddle")
 
+        if backend not in FIT_BACKENDS:
+            raise ValueError(f"Unknown fit backend {backend}; choose one of {FIT_BACKENDS}")
+
         outfile = None
         if output_file is not None:
             outfile = ROOT.TFile(output_file, "RECREATE")
@@ -455,65 +552,152 @@ class generalFunctions():
                                             h2d.GetXaxis().GetXmax()
                                         )
 
-        canvas = ROOT.TCanvas("canvas", "Fits", 800, 600)
-
-        for binx in range(1, h2d.GetNbinsX()+1):
-            h1d = h2d.ProjectionY(f"projection_{binx}", binx, binx)
-            h1d_maxbin = h1d.GetMaximumBin()
-            h1d_maxX = h1d.GetBinCenter(h1d_maxbin)
+        # 0 = converged; the Minuit status for the root backend and for the bins the numpy backend refits with ROOT
+        fit_status_hist = ROOT.TH1F("fit_status_"+h2d.GetName(), 
+                                            "Fit Status", 
+                                            h2d.GetNbinsX(), 
+                                            h2d.GetXaxis().GetXmin(), 
+                                            h2d.GetXaxis().GetXmax()
+                                        )
 
-            if h1d.GetEntries()==0: #Empty bins cause crashes when calling GetParameter(1)
-                continue
+        # {binx: (parameters, fit status)} for every non-empty x bin
+        fit_start, fit_cpu_start = time.perf_counter(), time.process_time()
+        fit_results, cache_key = None, None
+        if self.fit_cache is not None:
+            cache_key = self.fit_cache.key(h2d, fit_range=fit_range, max_straddle=max_straddle, backend=backend)
+            fit_results = self.fit_cache.load(cache_key)
 
-            fitted_function = ROOT.TF1("fitted_function", "gaus(0)+pol0(3)")
+        if fit_results is None:
+            if backend == "numpy":
+                fit_results = self.batch_fit_2d_histogram(h2d, fit_range=fit_range, max_straddle=max_straddle)
+            else:
+                fit_results = self.root_fit_2d_histogram(h2d, fit_range=fit_range, max_straddle=max_straddle)
 
-            fitted_function.SetParameters(h1d.GetMaximum(), h1d.GetMean(), 0.5)
+            if self.fit_cache is not None:
+                self.fit_cache.save(cache_key, fit_results)
+        else:
+            self.fit_stats["fit_cache_hits"] += 1
 
-            if fit_range is not None:
-                fit_min, fit_max = fit_range
-                fitted_function.SetRange(fit_min, fit_max)
-                fit_option = "QR+"
-            elif max_straddle:
-                fitted_function.SetRange(0.8*h1d_maxX, 1.2*h1d_maxX)
-                fit_option = "QR+"
-            else:
-                fit_option = "Q"
+        self.fit_stats["fits"] += 1
+        self.fit_stats["fitted_groups"] += len(fit_results)
+        self.fit_stats["fit_seconds"] += time.perf_counter() - fit_start
+        self.fit_stats["fit_cpu_seconds"] += time.process_time() - fit_cpu_start
 
-            fitted_function.SetParLimits(0, h1d.GetMaximum()*0.8, h1d.GetMaximum()*1.2)
-            fitted_function.SetParLimits(1, h1d.GetMean()*0.3, h1d.GetMean()*1.7)
-            fitted_function.SetParLimits(2, 0.1, 4)
-            fitted_function.SetParLimits(3, 0, 100)
-            
-            h1d.Fit("fitted_function", fit_option)
-            if fitted_function.GetParameter(2) < 0:
+        for binx, (params, fit_status) in fit_results.items():
+            if params[2] < 0:
                 print("Bin ", binx, " has a negative sigma. We will take the absolute value!")
             
-            fit_amplitudes_hist.SetBinContent(binx, fitted_function.GetParameter(0))
-            fit_means_hist.SetBinContent(binx, fitted_function.GetParameter(1))
-            fit_sigmas_hist.SetBinContent(binx, abs(fitted_function.GetParameter(2)))
-            fit_backgrounds_hist.SetBinContent(binx, fitted_function.GetParameter(3))
-
-            h1d.Draw()
-            fitted_function.Draw("same")
-            canvas.Update()
-            
-            if outfile is not None:
-                canvas.Write(f"fit_canvas_bin_{binx}")
-
+            fit_amplitudes_hist.SetBinContent(binx, params[0])
+            fit_means_hist.SetBinContent(binx, params[1])
+            fit_sigmas_hist.SetBinContent(binx, abs(params[2]))
+            fit_backgrounds_hist.SetBinContent(binx, params[3])
+            fit_status_hist.SetBinContent(binx, fit_status)
+
+        # Instead of a canvas per bin, the file keeps the fitted histogram and the fit settings;
+        # fitFileRenderer draws any bin from these when it is needed
         if outfile is not None:
+            outfile.cd()
+            h2d.Write("fit_input_hist")
+            ROOT.TNamed("fit_config", json.dumps({"fit_range": fit_range, "max_straddle": max_straddle, "backend": backend})).Write()
             fit_amplitudes_hist.Write("fit_amplitudes_hist")
             fit_means_hist.Write("fit_means_hist")
             fit_sigmas_hist.Write("fit_sigmas_hist")
             fit_backgrounds_hist.Write("fit_backgrounds_hist")
+            fit_status_hist.Write("fit_status_hist")
             fit_amplitudes_hist.SetDirectory(0)
             fit_means_hist.SetDirectory(0)
             fit_sigmas_hist.SetDirectory(0)
             fit_backgrounds_hist.SetDirectory(0)
+            fit_status_hist.SetDirectory(0)
             print(f"Output {outfile.GetName()} made!")
             outfile.Close()
 
         return fit_amplitudes_hist, fit_means_hist, fit_sigmas_hist, fit_backgrounds_hist
 
+    # The gaus+constant function for the fit of one projection, with its starting values, limits and range
+    def make_fit_function(self, h1d, fit_range=None, max_straddle=False):
+        h1d_maxbin = h1d.GetMaximumBin()
+        h1d_maxX = h1d.GetBinCenter(h1d_maxbin)
+
+        fitted_function = ROOT.TF1("fitted_function", "gaus(0)+pol0(3)")
+
+        fitted_function.SetParameters(h1d.GetMaximum(), h1d.GetMean(), 0.5)
+
+        if fit_range is not None:
+            fit_min, fit_max = fit_range
+            fitted_function.SetRange(fit_min, fit_max)
+            fit_option = "QR+"
+        elif max_straddle:
+            fitted_function.SetRange(0.8*h1d_maxX, 1.2*h1d_maxX)
+            fit_option = "QR+"
+        else:
+            fit_option = "Q"
+
+        fitted_function.SetParLimits(0, h1d.GetMaximum()*0.8, h1d.GetMaximum()*1.2)
+        fitted_function.SetParLimits(1, h1d.GetMean()*0.3, h1d.GetMean()*1.7)
+        fitted_function.SetParLimits(2, 0.1, 4)
+        fitted_function.SetParLimits(3, 0, 100)
+        return fitted_function, fit_option
+
+    # One TF1 fit per x bin. Returns {binx: (parameters, Minuit status)} for the non-empty bins.
+    def root_fit_2d_histogram(self, h2d, fit_range=None, max_straddle=False):
+        fit_results = {}
+        for binx in range(1, h2d.GetNbinsX()+1):
+            h1d = h2d.ProjectionY(f"projection_{binx}", binx, binx)
+            if h1d.GetEntries()==0: #Empty bins cause crashes when calling GetParameter(1)
+                continue
+
+            fitted_function, fit_option = self.make_fit_function(h1d, fit_range=fit_range, max_straddle=max_straddle)
+            fit_status = int(h1d.Fit("fitted_function", fit_option))
+            fit_results[binx] = ([fitted_function.GetParameter(i) for i in range(4)], fit_status)
+        return fit_results
+
+    # Fits the y projections of every x bin at once with batchFitter, using the same starting values, limits
+    # and fit ranges as the per-bin TF1 fits. The bins the batched fit does not converge on (it stalled or ran out of
+    # iterations) are fitted again with a TF1, so their parameters and status come from Minuit.
+    # Returns {binx: (parameters, fit status)} for the non-empty bins (status 0 = converged).
+    def batch_fit_2d_histogram(self, h2d, fit_range=None, max_straddle=False):
+        nx, ny = h2d.GetNbinsX(), h2d.GetNbinsY()
+        contents = self.hist_to_array(h2d)[1:ny+1, 1:nx+1].T.astype(np.float64)
+        if h2d.GetSumw2N() > 0:
+            errors = np.sqrt(self.hist_to_array(h2d, sumw2=True)[1:ny+1, 1:nx+1].T)
+        else:
+            errors = np.sqrt(np.abs(contents))
+
+        y_axis = h2d.GetYaxis()
+        centers = np.array([y_axis.GetBinCenter(by) for by in range(1, ny+1)])
+
+        totals = contents.sum(axis=1)
+        fitted_bins = np.flatnonzero(totals != 0)
+        contents, errors, totals = contents[fitted_bins], errors[fitted_bins], totals[fitted_bins]
+
+        maxima = contents.max(axis=1)
+        means = (contents*centers).sum(axis=1)/totals
+        if fit_range is not None:
+            fit_min, fit_max = np.full(len(fitted_bins), fit_range[0]), np.full(len(fitted_bins), fit_range[1])
+        elif max_straddle:
+            max_x = centers[contents.argmax(axis=1)]
+            fit_min, fit_max = 0.8*max_x, 1.2*max_x
+        else:
+            fit_min, fit_max = np.full(len(fitted_bins), centers[0]), np.full(len(fitted_bins), centers[-1])
+
+        use_points = (centers[None, :] >= fit_min[:, None]) & (centers[None, :] <= fit_max[:, None]) & (contents != 0)
+
+        zeros, ones = np.zeros(len(fitted_bins)), np.ones(len(fitted_bins))
+        initial = np.stack([maxima, means, 0.5*ones, zeros], axis=1)
+        lower = np.stack([maxima*0.8, means*0.3, 0.1*ones, zeros], axis=1)
+        upper = np.stack([maxima*1.2, means*1.7, 4*ones, 100*ones], axis=1)
+
+        params, chi2, status = fit_gaus_pol0(centers, contents, errors, use_points, initial, lower, upper)
+        fit_results = {int(binx)+1: (params[i].tolist(), 0) for i, binx in enumerate(fitted_bins)}
+        for binx in fitted_bins[status != CONVERGED]:
+            print("Bin ", int(binx)+1, " did not converge in the batched fit; fitting it again with ROOT")
+            h1d = h2d.ProjectionY(f"projection_{int(binx)+1}", int(binx)+1, int(binx)+1)
+            fitted_function, fit_option = self.make_fit_function(h1d, fit_range=fit_range, max_straddle=max_straddle)
+            fit_status = int(h1d.Fit("fitted_function", fit_option))
+            fit_results[int(binx)+1] = ([fitted_function.GetParameter(i) for i in range(4)], fit_status)
+        return fit_results
+
     # For taking an input histogram (1d) and a float to output the differences as 
     # another histogram of the same x range/bins as the input.
     def compute_difference_histogram(self, input_hist, referenceNum, hist_name_str=""):
@@ -551,13 +735,228 @@ class generalFunctions():
         df = pd.DataFrame(data, columns=[x_label, y_label])
         return df
 
+#Draws the fits of one fit information file (from generalFunctions.fit_2d_histogram), one x bin at a time, like the
+#per-bin canvases that used to be stored in the file. The fitted histogram, the fit parameters and the fit settings are
+#read once per file (every TFile.Get makes a new copy that the file keeps until it is closed).
+class fitFileRenderer():
+    def __init__(self, fit_file):
+        self.general = generalFunctions()
+        self.h2d = fit_file.Get("fit_input_hist")
+        self.h2d.SetDirectory(0)
+        self.config = json.loads(fit_file.Get("fit_config").GetTitle())
+        self.parameter_hists = []
+        for hist_name in ["fit_amplitudes_hist", "fit_means_hist", "fit_sigmas_hist", "fit_backgrounds_hist"]:
+            hist = fit_file.Get(hist_name)
+            hist.SetDirectory(0)
+            self.parameter_hists.append(hist)
+        self.canvas = None
+        self.drawn = [] #The projection and function on self.canvas, deleted by clear()
+
+    def nbins(self):
+        return self.h2d.GetNbinsX()
+
+    # Draws the fit of x bin binx onto the canvas. Returns False if the bin was empty and therefore not fitted.
+    # Call clear() once the canvas has been printed.
+    def render_fit_canvas(self, binx, canvas):
+        self.clear()
+        h1d = self.h2d.ProjectionY(f"projection_{binx}", binx, binx)
+        h1d.SetDirectory(0)
+        ROOT.SetOwnership(h1d, True)
+        if h1d.GetEntries()==0:
+            return False
+
+        fitted_function, fit_option = self.general.make_fit_function(h1d, fit_range=self.config["fit_range"], max_straddle=self.config["max_straddle"])
+        for i, hist in enumerate(self.parameter_hists):
+            fitted_function.SetParameter(i, hist.GetBinContent(binx))
+
+        canvas.cd()
+        h1d.Draw()
+        fitted_function.Draw("same")
+        canvas.Update()
+        self.canvas = canvas
+        self.drawn = [h1d, fitted_function]
+        return True
+
+    # Takes the last drawn fit off the canvas and deletes its projection and function
+    def clear(self):
+        if self.canvas is not None:
+            self.canvas.Clear()
+            self.canvas = None
+        for obj in self.drawn:
+            ROOT.SetOwnership(obj, True) #Draw hands the objects over to ROOT, so they would not be deleted otherwise
+        self.drawn = []
+
+#On-disk cache of fit_2d_histogram results. The key is a hash of the histogram (binning, contents and errors) and of
+#the fit configuration, so any change to the data, the fit range, the backend or the fit model means a new fit.
+#Every entry is one small .npz file; when the cache grows past max_size_mb the least recently used entries are removed.
+#The directory is only listed by scan() (on construction); after that the entry sizes and their order of use are kept
+#in memory, so a save does not have to stat the whole cache. run.py -j workers each only know their own entries, so
+#run.py scans and evicts once more at the end of the run.
+class fitCache():
+    def __init__(self, directory, max_size_mb=500, clear=False):
+        self.directory = directory
+        self.max_size = max_size_mb*1024*1024
+        os.makedirs(directory, exist_ok=True)
+        if clear:
+            self.clear()
+        self.scan()
+        self.evict()
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+        self.entries = collections.OrderedDict()
+        self.total_size = 0
+
+    #Entry name -> size, least recently used first
+    def scan(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+
+        self.entries = collections.OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.total_size = sum(self.entries.values())
+
+    #Marks an entry as the most recently used one
+    def touch(self, key, size=None):
+        name = key+".npz"
+        if size is None:
+            size = self.entries.get(name)
+            if size is None: #Written by another process
+                size = os.path.getsize(self.path(key))
+        self.total_size += size - self.entries.get(name, 0)
+        self.entries[name] = size
+        self.entries.move_to_end(name)
+
+    def key(self, h2d, fit_range=None, max_straddle=False, backend="root"):
+        general = generalFunctions()
+        digest = hashlib.sha256()
+        config = {
+                "version": FIT_CACHE_VERSION, 
+                "model": FIT_MODEL, 
+                "fit_range": fit_range, 
+                "max_straddle": max_straddle, 
+                "backend": backend, 
+                "x_axis": [h2d.GetNbinsX(), h2d.GetXaxis().GetXmin(), h2d.GetXaxis().GetXmax()], 
+                "y_axis": [h2d.GetNbinsY(), h2d.GetYaxis().GetXmin(), h2d.GetYaxis().GetXmax()]
+            }
+        digest.update(json.dumps(config, sort_keys=True).encode())
+        digest.update(np.ascontiguousarray(general.hist_to_array(h2d), dtype=np.float64).tobytes())
+        if h2d.GetSumw2N() > 0:
+            digest.update(np.ascontiguousarray(general.hist_to_array(h2d, sumw2=True)).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key+".npz")
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                fit_results = {int(binx): (params.tolist(), int(status)) for binx, params, status in zip(entry["bins"], entry["params"], entry["status"])}
+            os.utime(path) #Marks the entry as recently used
+            self.touch(key)
+        except FileNotFoundError: #Never cached, or just evicted by another process
+            return None
+        return fit_results
+
+    def save(self, key, fit_results):
+        bins = sorted(fit_results)
+        temp_path = self.path(key)+f".{os.getpid()}.tmp.npz" #Per process, as run.py -j workers share the cache
+        np.savez(
+                temp_path, 
+                bins=np.array(bins, dtype=np.int64), 
+                params=np.array([fit_results[binx][0] for binx in bins], dtype=np.float64).reshape(len(bins), 4), 
+                status=np.array([fit_results[binx][1] for binx in bins], dtype=np.int64)
+            )
+        self.touch(key, size=os.path.getsize(temp_path))
+        os.replace(temp_path, self.path(key))
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        while self.total_size > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            self.total_size -= size
+
+#Collects the delays and hot channels of all chambers and writes every output file once, at the end of run.py.
+#Each file is written to a temporary name first and then moved into place, so an interrupted run never leaves
+#half-written outputs. With columnar=True the delays are also saved as delays/delays.npz (one array per column).
+class delayOutputWriter():
+    group_columns = ["padID", "fed", "amc", "oh", "vfat", "group", "bunchDelay"]
+    gbt_columns = ["padID", "fed", "amc", "oh", "gbt", "gbtDelay"]
+
+    def __init__(self, baseName, columnar=False):
+        self.baseName = baseName
+        self.columnar = columnar
+        self.group_dfs = []
+        self.gbt_dfs = []
+        self.all_hot_channels = {}
+
+    def add(self, group_df, gbt_df, hot_channels):
+        self.group_dfs.append(group_df[self.group_columns])
+        self.gbt_dfs.append(gbt_df[self.gbt_columns])
+
+        for chamber, channels in hot_channels.items():
+            if chamber not in self.all_hot_channels:
+                self.all_hot_channels[chamber] = set()
+
+            self.all_hot_channels[chamber].update(channels)
+
+    def combined(self, dfs, columns):
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(dfs, ignore_index=True)
+
+    def atomic_write(self, path, write):
+        temp_path = path+".tmp"
+        write(temp_path)
+        os.replace(temp_path, path)
+
+    def write(self):
+        group_df = self.combined(self.group_dfs, self.group_columns)
+        gbt_df = self.combined(self.gbt_dfs, self.gbt_columns)
+
+        self.atomic_write(f"{self.baseName}/delays/group_delays.csv", lambda path: group_df.to_csv(path, index=False))
+        self.atomic_write(f"{self.baseName}/delays/gbt_delays.csv", lambda path: gbt_df.to_csv(path, index=False))
+
+        def write_hot_channels(path):
+            with open(path, "w") as f:
+                for chamber, channels in self.all_hot_channels.items():
+                    f.write(f"{chamber}: {sorted(channels)}\n")
+        self.atomic_write(f"{self.baseName}/all_hot_channels.txt", write_hot_channels)
+
+        if self.columnar:
+            columns = {"group_"+column: group_df[column].to_numpy() for column in self.group_columns}
+            columns.update({"gbt_"+column: gbt_df[column].to_numpy() for column in self.gbt_columns})
+            #np.savez appends .npz to names without it, so the temporary name has to end in .npz as well
+            temp_path = f"{self.baseName}/delays/delays.tmp.npz"
+            np.savez(temp_path, **columns)
+            os.replace(temp_path, f"{self.baseName}/delays/delays.npz")
+
 #For pulling the data to be processed
+#With a store (see mcdonaldsStore.py), the chamber named by file_path is read from the memory-mapped McDonalds store
+#instead of from its own .root file.
 class dataRetriever():
-    def __init__(self, file_path):
+    def __init__(self, file_path, store=None):
         self.file_path = file_path
+        self.store = store
         self.histo_name, self.histo = self.retriever()
         
     def retriever(self):
+        if self.store is not None:
+            return self.store_retriever()
+
         input_file = ROOT.TFile.Open(self.file_path)
         for key in input_file.GetListOfKeys():
             if "GE" in str(key.GetName()):
@@ -571,5 +970,12 @@ class dataRetriever():
                     return input_histo_name, input_histo
             else:
                 raise ValueError("Was not able to locate the proper histo within .root file! :angerey_face:")
+
+    def store_retriever(self):
+        input_histo_name = self.file_path.split("/")[-1].replace(".root","")
+        if self.store.entries(input_histo_name) == 0:
+            print("\033[91mThe chamber \033[0m", input_histo_name, "\033[91mhas no entries!\033[0m")
+            return None, None
+        return input_histo_name, self.store.to_hist(input_histo_name)
             
             
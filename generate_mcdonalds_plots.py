@@ -7,15 +7,13 @@
 
 #Code by Jacob Steenis, 2024 
 
-import uproot
-import awkward as ak
 import ROOT
-from array import array
-import numpy as np
 import os
 import glob
 import argparse
 from setup import ensure_folders_exist
+from mcdonaldsClasses import *
+from runMetrics import runMetrics
 
 ROOT.gROOT.SetBatch(1)
 
@@ -27,30 +25,34 @@ def find_root_files(directory):
         root_files.extend(glob.glob(os.path.join(root, "*.root")))
     return root_files
 
-def clusterIdExpander(firstId, numPads, etaPartition, **kwargs):
-    output = [(firstId + x) + (8 - etaPartition)*192 for x in range(numPads)]
-    #print("NumPads: ", numPads, "FirstID: ", firstId, "Output: ", output)
-    return output
-
-def clusterBXExpander(BX, numPads, **kwargs):
-    output = [BX for x in range(numPads)]
-    #print("NumPads: ", numPads, "PadBX: ", BX, "Output: ", output)
-    return output
-
-def shiftingBX(gemPadDigiCluster_PadBX, CSCConstants_LCT_CENTRAL_BX, tmbL1aWindowSize, gemPadDigiCluster_ClusterALCTMatchTime):
-    gemBX = gemPadDigiCluster_PadBX + CSCConstants_LCT_CENTRAL_BX - int(tmbL1aWindowSize/2.0) - gemPadDigiCluster_ClusterALCTMatchTime 
-    return gemBX
+#The GEM common ntuples on EOS, one folder per run
+NTUPLE_DIR = "/eos/cms/store/group/dpg_gem/comm_gem/P5_Commissioning/cms-gem-automation/prod/prompt-v1/GEMCommonNTuples/"
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--run', type=int, default=None, help='Process a single run number')
-    parser.add_argument('-l', '--limit', type=int, default=None, help='Limit the number of uproot iterations')
+    parser.add_argument('--input_dir', type=str, default=NTUPLE_DIR, help='Directory holding one folder of ntuples per run (e.g. synthetic ntuples from benchmarks/synthetic_ntuples.py)')
+    parser.add_argument('-l', '--limit', type=int, default=None, help='Only read the first (limit+1)*100,000 events of the run')
+    parser.add_argument('--memory_budget', type=float, default=500, help='Memory [MB] for one chunk of events per process; chunks are sized to it from the basket sizes and what earlier chunks needed')
+    parser.add_argument('--prefetch', type=int, default=1, help='Number of chunks read ahead on a background thread while the current chunk is processed (0 reads in the main thread)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes reading the ntuple files')
+    parser.add_argument('--shard', type=str, default=None, help='Only process shard i of N of the run (e.g. 0/8); combine them with merge_mcdonalds_shards.py')
+    parser.add_argument('--fresh', action='store_true', help='Ignore the checkpoints of earlier runs and reprocess every file')
+    parser.add_argument('--cache', action='store_true', help='Also write the matched hit table to a local columnar cache (matched_cache/)')
+    parser.add_argument('--from_cache', action='store_true', help='Rebuild the McDonalds plots from the matched hit cache instead of the ntuples')
+    parser.add_argument('--pt_min', type=float, default=10, help='Muon pT cut [GeV]')
+    parser.add_argument('--proximity', type=int, default=5, help='Maximum |cluster first pad - muon pad| for a match')
+    parser.add_argument('--central_bx', type=int, default=8, help='CSCConstants_LCT_CENTRAL_BX used to shift the pad BX')
+    parser.add_argument('--l1a_window', type=int, default=7, help='tmbL1aWindowSize used to shift the pad BX')
+    parser.add_argument('--cache_pt_min', type=float, default=5, help='Looser pT cut used for the matched hit cache')
+    parser.add_argument('--cache_proximity', type=int, default=10, help='Looser proximity cut used for the matched hit cache')
+    parser.add_argument('--root', action='store_true', help='Also export the old one .root file per chamber next to the McDonalds store')
     args = parser.parse_args()
     return args
 
 if __name__ == '__main__':
     args = parse_args()
-    pathName = "/eos/cms/store/group/dpg_gem/comm_gem/P5_Commissioning/cms-gem-automation/prod/prompt-v1/GEMCommonNTuples/"
+    pathName = os.path.join(args.input_dir, "")
 
     if args.run is not None:
         pathName += f"{args.run}"
@@ -62,283 +64,75 @@ if __name__ == '__main__':
         output_baseName = f"GEM_mcdonalds_data/default/"
         ensure_folders_exist("GEM_mcdonalds_data", ['default'])
 
-    ensure_folders_exist("temp_canvas_images", [])
-
-    filelist = find_root_files(pathName)
-    tree_name = "muNtupleProducer/MuDPGTree"
-
-    filelist = [x+":"+tree_name for x in filelist]
-
-    cluster_variables = [
-                            "gemPadDigiCluster_layer", 
-                            "gemPadDigiCluster_station", 
-                            "gemPadDigiCluster_region", 
-                            "gemPadDigiCluster_ClusterFirstPad", 
-                            "gemPadDigiCluster_PadBX", 
-                            "gemPadDigiCluster_PadClusterSize", 
-                            "gemPadDigiCluster_etaPartition", 
-                            "gemPadDigiCluster_chamber", 
-                            "gemPadDigiCluster_ClusterALCTMatchTime"
-                        ]
-
-    muon_variables = [
-                        "mu_propagated_isME11", 
-                        "mu_propagated_station", 
-                        "mu_propagated_region", 
-                        "mu_propagated_Outermost_z", 
-                        "mu_propagated_etaP", 
-                        "mu_propagated_pt", 
-                        "mu_propagated_chamber", 
-                        "mu_propagated_strip", 
-                        "mu_propagated_layer"
-                    ]
-
-    variables = cluster_variables + muon_variables
+    #-l/--limit still counts in units of the old fixed chunk size
+    limit_step = 100000
+    cache_dir = None
+    if args.cache or args.from_cache:
+        cache_dir = output_baseName+"matched_cache"
+        ensure_folders_exist(output_baseName, ["matched_cache"])
 
     #output_path = f"results/GEM_delay_data.root"
     #hot_output = ROOT.TFile("hotChannelsRemoved.root", "RECREATE")
 
-    chamber_hists = {}
-
-    # Define the station, layer, and region values
-    stations = [1, 2]
-    layers = [1, 2]
-    regions = [-1, 1]
-    chambers = range(1,36+1)
-
-    CSCConstants_LCT_CENTRAL_BX, tmbL1aWindowSize = 8, 7
-
-    # Loop over station, layer, and region
-    for station in stations:
-        for layer in layers:
-            for region in regions:
-                for chamber in chambers:
-                    #To prevent naming issues when accessing via root
-                    region_label = str(region)
-                    if region<0:
-                        #region_label = str(region).replace("-","neg")
-                        region_label = str(region).replace("-1","M")
-                    elif region>0:
-                        region_label = str(region).replace("1","P")
-                
-                    hist_name = f"GE{station}1_{region_label}_{chamber}_L{layer}"
-    
-                    temp_hist = ROOT.TH2D(
-                                            hist_name, 
-                                            hist_name, 
-                                            int(1536), 
-                                            -0.5, 
-                                            1535.5, 
-                                            24*120, 
-                                            0-0.004166666666666666-0.5, 
-                                            24-0.004166666666666666-0.5
-                                        )
-
-                    temp_hist.GetXaxis().SetTitle("Expanded Pad ID")
-                    temp_hist.GetYaxis().SetTitle("Time [bx]")
-                    temp_hist.SetDirectory(0)
-
-                    chamber_hists[hist_name] = {
-                                                "station": station, 
-                                                "region_label": region_label, 
-                                                "chamber": chamber, 
-                                                "layer": layer, 
-                                                "data": temp_hist
-                                            } 
-
-
-    # Loop over chunks of data using uproot.iterate
-    counter = 0
-    counter_limit = args.limit #None if you want to run everything
-    for data in uproot.iterate(filelist, variables, library='ak', step_size=100000):     
-        if counter_limit!=None:
-            if counter>counter_limit:
-                break
-        counter+=1
-        print("Working on event: ", counter*100000)
-
-
-        muon_data = data[muon_variables]
-        cluster_data = data[cluster_variables]
-        #Check to make sure that we've got some sort of ME11 hit in the events
-        ME11_mask = ak.any(muon_data['mu_propagated_isME11'], axis=-1)
-        muon_data = muon_data[ME11_mask]
-        cluster_data = cluster_data[ME11_mask]
-
-        muon_location_mask = (
-                                (muon_data['mu_propagated_isME11']) 
-                                & (muon_data['mu_propagated_station']==1) 
-                                & (muon_data['mu_propagated_region']*muon_data['mu_propagated_Outermost_z']>0) 
-                                & (muon_data['mu_propagated_etaP']>=1) 
-                                & (muon_data['mu_propagated_etaP']<=8) 
-                                & (muon_data['mu_propagated_pt']>10)
+    producer = mcdonaldsProducer(
+                                memory_budget_mb=args.memory_budget, 
+                                prefetch=args.prefetch, 
+                                CSCConstants_LCT_CENTRAL_BX=args.central_bx, 
+                                tmbL1aWindowSize=args.l1a_window, 
+                                proximity=args.proximity, 
+                                pt_min=args.pt_min, 
+                                cache_dir=cache_dir, 
+                                cache_pt_min=args.cache_pt_min, 
+                                cache_proximity=args.cache_proximity
                             )
 
-        muon_data = muon_data[muon_location_mask]
-
-        num_mask = ak.num(muon_data['mu_propagated_isME11'])>0
-        muon_data = muon_data[num_mask]
-        cluster_data = cluster_data[num_mask]
-
-        chamber_combinations = ak.cartesian(
-                                        {"muon_chamber": muon_data['mu_propagated_chamber'], 
-                                        "cluster_chamber": cluster_data['gemPadDigiCluster_chamber']}
-                                    )
-
-        layer_combinations = ak.cartesian(
-                                        {"muon_layer": muon_data['mu_propagated_layer'], 
-                                        "cluster_layer": cluster_data['gemPadDigiCluster_layer']}
-                                    )
-
-        station_combinations = ak.cartesian(
-                                        {"muon_station": muon_data['mu_propagated_station'], 
-                                        "cluster_station": cluster_data['gemPadDigiCluster_station']}
-                                    )
-
-        region_combinations = ak.cartesian(
-                                        {"muon_region": muon_data['mu_propagated_region'], 
-                                        "cluster_region": cluster_data['gemPadDigiCluster_region']}
-                                    )
-
-        eta_combinations = ak.cartesian(
-                                        {"muon_eta": muon_data['mu_propagated_etaP'], 
-                                        "cluster_eta": cluster_data['gemPadDigiCluster_etaPartition']}
-                                    )
+    checkpoint_dir = output_baseName+"checkpoints"
+    if args.shard is not None:
+        #Only this job's slice of the run; the partial counts are combined later with merge_mcdonalds_shards.py
+        shard_index, n_shards = parse_shard(args.shard)
+        checkpoint_dir += f"/shard_{shard_index}_of_{n_shards}"
 
-        proximity_combinations = ak.cartesian(
-                                        {"muon_prox": muon_data['mu_propagated_strip'], 
-                                        "cluster_prox": cluster_data['gemPadDigiCluster_ClusterFirstPad']}
-                                    )
-
-        location_mask = (
-                    (chamber_combinations['muon_chamber'] == chamber_combinations['cluster_chamber']) 
-                    & (layer_combinations['muon_layer'] == layer_combinations['cluster_layer']) 
-                    & (station_combinations['muon_station'] == station_combinations['cluster_station']) 
-                    & (region_combinations['muon_region'] == region_combinations['cluster_region']) 
-                    & (eta_combinations['muon_eta'] == eta_combinations['cluster_eta'])
-                )
-
-        #To convert between strip and pad
-        proximity_combinations['muon_prox'] = np.floor(proximity_combinations['muon_prox']/2.0)
-        proximity_mask = (abs(proximity_combinations['cluster_prox'] - proximity_combinations['muon_prox']) <= 5)
-
-        #Preparing the actual data
-        BX_combinations = ak.cartesian(
-                                        {"muon_chamber": muon_data['mu_propagated_chamber'], 
-                                        "cluster_PadBX": cluster_data['gemPadDigiCluster_PadBX']}
-                                    )
-
-        ALC_combinations = ak.cartesian(
-                                        {"muon_chamber": muon_data['mu_propagated_chamber'], 
-                                        "cluster_ALC": cluster_data['gemPadDigiCluster_ClusterALCTMatchTime']}
-                                    )
-
-        size_combinations = ak.cartesian(
-                                        {"muon_chamber": muon_data['mu_propagated_chamber'], 
-                                        "cluster_size": cluster_data['gemPadDigiCluster_PadClusterSize']}
-                                    )
-
-        firstPad_combinations = ak.cartesian(
-                                        {"muon_chamber": muon_data['mu_propagated_chamber'], 
-                                        "cluster_firstPad": cluster_data['gemPadDigiCluster_ClusterFirstPad']}
-                                    )
-
-        BX_combinations = BX_combinations[location_mask & proximity_mask]
-        ALC_combinations = ALC_combinations[location_mask & proximity_mask]
-        size_combinations = size_combinations[location_mask & proximity_mask]
-        eta_combinations = eta_combinations[location_mask & proximity_mask]
-        firstPad_combinations = firstPad_combinations[location_mask & proximity_mask]
-
-        chamber_combinations = chamber_combinations[location_mask & proximity_mask]
-        layer_combinations = layer_combinations[location_mask & proximity_mask]
-        station_combinations = station_combinations[location_mask & proximity_mask]
-        region_combinations = region_combinations[location_mask & proximity_mask]
-
-        for station in stations:
-            for layer in layers:
-                for region in regions:
-                    for chamber in chambers:
-                        #To prevent naming issues when accessing via root
-                        region_label = str(region)
-
-                        if region<0:
-                            region_label = str(region).replace("-1","M")
-                        elif region>0:
-                            region_label = str(region).replace("1","P")
-
-                        hist_station_mask = station_combinations['cluster_station'] == station
-                        hist_layer_mask = layer_combinations['cluster_layer'] == layer
-                        hist_region_mask = region_combinations['cluster_region'] == region
-                        hist_chamber_mask = chamber_combinations['cluster_chamber'] == chamber
-                        hist_location_mask = hist_station_mask & hist_layer_mask & hist_chamber_mask & hist_region_mask
-
-                        gemBX_zipped = zip(
-                                            ak.flatten(
-                                                BX_combinations['cluster_PadBX'][hist_location_mask],
-                                                axis=None
-                                                ),
-
-                                            ak.flatten(
-                                                ALC_combinations['cluster_ALC'][hist_location_mask],
-                                                axis=None
-                                                )
-                                        )
-
-                        gemBX_preAwk = [
-                                        shiftingBX(gemPadDigiCluster_PadBX, 
-                                            CSCConstants_LCT_CENTRAL_BX, 
-                                            tmbL1aWindowSize, 
-                                            gemPadDigiCluster_ClusterALCTMatchTime
-                                        ) 
-
-                                        for gemPadDigiCluster_PadBX, gemPadDigiCluster_ClusterALCTMatchTime in gemBX_zipped
-                                    ]
-
-                        gemBX = ak.Array(gemBX_preAwk)
-                        
-                        expandedClusters_zipped = zip(
-                                                        ak.flatten(
-                                                            firstPad_combinations['cluster_firstPad'][hist_location_mask],
-                                                            axis=None
-                                                        ), 
-                                                        
-                                                        ak.flatten(
-                                                            size_combinations['cluster_size'][hist_location_mask],
-                                                            axis=None
-                                                        ), 
-                                                        
-                                                        ak.flatten(
-                                                            eta_combinations['cluster_eta'][hist_location_mask])
-                                                    )
-
-                        expandedClusters_preAwk = [
-                                                    clusterIdExpander(firstId, 
-                                                            numPads, 
-                                                            etaPartition
-                                                        ) 
-                                                    for firstId, numPads, etaPartition in expandedClusters_zipped
-                                                ]
-                                                    
-                        expandedClusters = ak.Array(expandedClusters_preAwk)
-                       
-                        expandedBX_zipped = zip(gemBX, ak.flatten(size_combinations['cluster_size'][hist_location_mask],axis=None)) 
-                        expandedBX_preAwk = [clusterBXExpander(firstId, numPads) for firstId, numPads in expandedBX_zipped]
-                        expandedBX = ak.Array(expandedBX_preAwk)
-
-                        # Fill the histogram using FillN()
-                        if len(expandedClusters) != len(expandedBX):
-                            print("DIFFERENT LENGTHS OF CLUSTERS AND BXs")
-                        n_events = len(ak.flatten(expandedClusters, axis=None))
-                        x_data = ak.flatten(expandedClusters, axis=None)
-                        y_data = ak.flatten(expandedBX, axis=None)
-                        weights = ak.ones_like(ak.flatten(expandedBX, axis=None))
-
-                        if n_events>0:
-                            name = f"GE{station}1_{region_label}_{chamber}_L{layer}"
-                            chamber_hists[name]['data'].FillN(n_events, array('d', x_data), array('d', y_data), array('d', weights))
-
-    #hot_output.Close()
-    for chamber in chamber_hists.keys():
-        chamber_hists[chamber]['data'].SaveAs(output_baseName+str(chamber)+".root")
+    #Stage timings, a record per chunk/task and the throughput of this run (one metrics file per shard)
+    metrics_path = output_baseName+"metrics.jsonl"
+    if args.shard is not None:
+        metrics_path = output_baseName+f"metrics_shard_{shard_index}_of_{n_shards}.jsonl"
+    metrics = runMetrics(metrics_path, step="generate_mcdonalds_plots", run=args.run, jobs=args.jobs, shard=args.shard, settings=producer.settings())
 
+    if args.from_cache:
+        #Same tasks as the run that wrote the cache, but the hits come from the local matched-hit table
+        tasks = manifest_tasks(checkpoint_dir)
+        with metrics.stage("rebuild from cache"):
+            hits = producer.rebuild_from_cache(tasks)
 
+    else:
+        with metrics.stage("listing files"):
+            filelist = find_root_files(pathName)
+
+            #-l/--limit keeps its old meaning of (limit+1)*100,000 events
+            max_entries = None if args.limit is None else (args.limit+1)*limit_step
+            tasks = make_tasks(filelist, max_entries=max_entries)
+            if args.shard is not None:
+                tasks = shard_tasks(tasks, shard_index, n_shards)
+
+        #Sparse (chamber, pad, BX) counts; the full TH2Ds are only made one at a time when writing out
+        checkpoints = checkpointStore(checkpoint_dir, producer.settings(), fresh=args.fresh)
+        hits = run_tasks(producer, tasks, n_jobs=args.jobs, checkpoints=checkpoints, metrics=metrics)
+
+    with metrics.stage("writing outputs"):
+        if args.shard is not None:
+            output_path = shard_path(output_baseName, shard_index, n_shards)
+            ensure_folders_exist(output_baseName, ["shards"])
+            hits.save(output_path, shard_index=shard_index, n_shards=n_shards, settings=producer.settings(), tasks=tasks)
+            print(f"Shard output {output_path} made! Run merge_mcdonalds_shards.py once all {n_shards} shards are done.")
+        else:
+            #hot_output.Close()
+            write_mcdonalds_outputs(hits, output_baseName, root_files=args.root)
+
+    #Checkpointed tasks are not counted, so this is the rate of the events read in this run
+    processed_events = metrics.counters.get("events", 0)
+    summary = metrics.close(
+                                total_events=sum(task["entry_stop"] - task["entry_start"] for task in tasks), 
+                                processed_events=processed_events, 
+                                events_per_second=processed_events/metrics.elapsed()
+                            )
+    print(f"  Processed {processed_events} events at {summary['events_per_second']:.0f} events/s")
@@ -0,0 +1,900 @@
+#These are the classes/functions used by generate_mcdonalds_plots.py to build the McDonalds (padID vs BX) data.
+#The hits are only ever held as sparse integer counts; the 1/120 BX ROOT histograms are only made on request.
+#Code by Jacob Steenis, 2024/2025
+import concurrent.futures
+import multiprocessing
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+import awkward as ak
+import uproot
+from mcdonaldsStore import make_mcdonalds_hist, fill_mcdonalds_hist, write_store
+from runMetrics import stageTimes, progressLine, peak_rss_mb
+
+# Define the station, layer, and region values
+stations = [1, 2]
+layers = [1, 2]
+regions = [-1, 1]
+chambers = range(1,36+1)
+
+N_PADS = 1536 #Expanded pads per chamber (8 eta partitions x 192 pads)
+PAD_SPAN = N_PADS + 2 #Room for the under/overflow pads, exactly like the ROOT x-axis
+N_CHAMBERS = len(stations)*len(layers)*len(regions)*len(chambers)
+
+#The BX is stored as an offset so that negative (shifted) BXs are still allowed
+BX_OFFSET = 512
+BX_SPAN = 1024
+
+#Composite chamber index in [0, 288). Ordered like the original station/layer/region/chamber loops.
+#Works on ints or on numpy arrays.
+def chamber_index(station, region, chamber, layer):
+    return (((station - 1)*len(layers) + (layer - 1))*len(regions) + (region > 0))*len(chambers) + (chamber - 1)
+
+#Composite chamber index of every cluster in one pass, plus a mask of the clusters on a known chamber
+def route_clusters(station, region, chamber, layer):
+    station, region, chamber, layer = [np.asarray(x, dtype=np.int64) for x in (station, region, chamber, layer)]
+    valid = (
+                np.isin(station, stations) 
+                & np.isin(region, regions) 
+                & np.isin(layer, layers) 
+                & (chamber >= chambers[0]) 
+                & (chamber <= chambers[-1])
+            )
+    return chamber_index(station, region, chamber, layer), valid
+
+def chamber_name(station, region, chamber, layer):
+    #To prevent naming issues when accessing via root
+    if region<0:
+        region_label = "M"
+    else:
+        region_label = "P"
+    return f"GE{station}1_{region_label}_{chamber}_L{layer}"
+
+#Index -> (station, region, chamber, layer) and index -> histogram name
+chamber_info = sorted(
+                        [(st, reg, ch, lay) for st in stations for lay in layers for reg in regions for ch in chambers],
+                        key=lambda info: chamber_index(*info)
+                    )
+chamber_names = [chamber_name(*info) for info in chamber_info]
+
+def shiftingBX(gemPadDigiCluster_PadBX, CSCConstants_LCT_CENTRAL_BX, tmbL1aWindowSize, gemPadDigiCluster_ClusterALCTMatchTime):
+    gemBX = gemPadDigiCluster_PadBX + CSCConstants_LCT_CENTRAL_BX - int(tmbL1aWindowSize/2.0) - gemPadDigiCluster_ClusterALCTMatchTime 
+    return gemBX
+
+#Expands every cluster into its individual expanded pad IDs and gives each pad the (shifted) BX of its cluster.
+#Inputs are flat per-cluster columns; the outputs are contiguous int64 numpy buffers with one entry per pad.
+def expand_clusters(firstPad, size, etaPartition, padBX, alctMatchTime, CSCConstants_LCT_CENTRAL_BX=8, tmbL1aWindowSize=7):
+    size = np.maximum(np.asarray(size, dtype=np.int64), 0)
+    firstId = np.asarray(firstPad, dtype=np.int64) + (8 - np.asarray(etaPartition, dtype=np.int64))*192
+    gemBX = shiftingBX(np.asarray(padBX, dtype=np.int64), 
+                        CSCConstants_LCT_CENTRAL_BX, 
+                        tmbL1aWindowSize, 
+                        np.asarray(alctMatchTime, dtype=np.int64)
+                    )
+
+    #Position of every pad within its own cluster: 0, 1, ..., size-1
+    cluster_starts = np.cumsum(size) - size
+    pad_in_cluster = np.arange(size.sum(), dtype=np.int64) - np.repeat(cluster_starts, size)
+
+    expanded_pads = np.repeat(firstId, size) + pad_in_cluster
+    expanded_bxs = np.repeat(gemBX, size)
+    return expanded_pads, expanded_bxs
+
+tree_name = "muNtupleProducer/MuDPGTree"
+
+cluster_variables = [
+                        "gemPadDigiCluster_layer", 
+                        "gemPadDigiCluster_station", 
+                        "gemPadDigiCluster_region", 
+                        "gemPadDigiCluster_ClusterFirstPad", 
+                        "gemPadDigiCluster_PadBX", 
+                        "gemPadDigiCluster_PadClusterSize", 
+                        "gemPadDigiCluster_etaPartition", 
+                        "gemPadDigiCluster_chamber", 
+                        "gemPadDigiCluster_ClusterALCTMatchTime"
+                    ]
+
+muon_variables = [
+                    "mu_propagated_isME11", 
+                    "mu_propagated_station", 
+                    "mu_propagated_region", 
+                    "mu_propagated_Outermost_z", 
+                    "mu_propagated_etaP", 
+                    "mu_propagated_pt", 
+                    "mu_propagated_chamber", 
+                    "mu_propagated_strip", 
+                    "mu_propagated_layer"
+                ]
+
+variables = cluster_variables + muon_variables
+
+#Peak memory of a chunk (reading, muon selection, matching and filling) relative to the uncompressed bytes it reads
+CHUNK_MEMORY_FACTOR = 4.0
+
+#Spans used to pack the exact matching keys (event, station, region, chamber, layer, eta) and the pad into one int64
+KEY_SPANS = {"station": 8, "region": 4, "chamber": 64, "layer": 8, "eta": 32}
+PAD_KEY_OFFSET = 1024
+PAD_KEY_SPAN = 4096
+
+def _exact_key(event, station, region, chamber, layer, eta):
+    key = np.asarray(event, dtype=np.int64)
+    valid = np.ones(len(key), dtype=bool)
+    for name, values in (("station", station), ("region", region), ("chamber", chamber), ("layer", layer), ("eta", eta)):
+        values = np.asarray(values, dtype=np.int64)
+        if name == "region":
+            values = values + 1 #-1/0/1 -> 0/1/2
+        valid &= (values >= 0) & (values < KEY_SPANS[name])
+        key = key*KEY_SPANS[name] + np.clip(values, 0, KEY_SPANS[name] - 1)
+    return np.where(valid, key, -1)
+
+def _pad_key(key, pad):
+    return key*PAD_KEY_SPAN + np.clip(np.asarray(pad, dtype=np.int64) + PAD_KEY_OFFSET, 0, PAD_KEY_SPAN - 1)
+
+def _flat(arr):
+    return ak.to_numpy(ak.flatten(arr, axis=1))
+
+#Joins muons and clusters of the same event on the exact location keys, then keeps the clusters with
+#|firstPad - floor(strip/2)| <= proximity using a sorted window search. This replaces the n_muons x n_clusters
+#cartesian products. Returns one flat table (dict of numpy columns) with a row per matched (muon, cluster) pair.
+def match_clusters(muon_data, cluster_data, proximity=5):
+    n_muons = ak.to_numpy(ak.num(muon_data['mu_propagated_chamber'], axis=1))
+    n_clusters = ak.to_numpy(ak.num(cluster_data['gemPadDigiCluster_chamber'], axis=1))
+
+    muon_key = _exact_key(
+                            np.repeat(np.arange(len(n_muons)), n_muons), 
+                            _flat(muon_data['mu_propagated_station']), 
+                            _flat(muon_data['mu_propagated_region']), 
+                            _flat(muon_data['mu_propagated_chamber']), 
+                            _flat(muon_data['mu_propagated_layer']), 
+                            _flat(muon_data['mu_propagated_etaP'])
+                        )
+
+    cluster_key = _exact_key(
+                            np.repeat(np.arange(len(n_clusters)), n_clusters), 
+                            _flat(cluster_data['gemPadDigiCluster_station']), 
+                            _flat(cluster_data['gemPadDigiCluster_region']), 
+                            _flat(cluster_data['gemPadDigiCluster_chamber']), 
+                            _flat(cluster_data['gemPadDigiCluster_layer']), 
+                            _flat(cluster_data['gemPadDigiCluster_etaPartition'])
+                        )
+
+    #To convert between strip and pad
+    muon_pad = np.floor(_flat(muon_data['mu_propagated_strip'])/2.0).astype(np.int64)
+
+    #Clusters sorted by (exact key, firstPad); each muon then owns one contiguous window of that order
+    cluster_sort_key = _pad_key(cluster_key, _flat(cluster_data['gemPadDigiCluster_ClusterFirstPad']))
+    cluster_order = np.argsort(cluster_sort_key, kind='stable')
+    sorted_keys = cluster_sort_key[cluster_order]
+
+    window_lo = np.searchsorted(sorted_keys, _pad_key(muon_key, muon_pad - proximity), side='left')
+    window_hi = np.searchsorted(sorted_keys, _pad_key(muon_key, muon_pad + proximity), side='right')
+    n_matches = np.where(muon_key >= 0, window_hi - window_lo, 0)
+
+    muon_idx = np.repeat(np.arange(len(muon_key)), n_matches)
+    match_starts = np.cumsum(n_matches) - n_matches
+    position = np.repeat(window_lo, n_matches) + np.arange(n_matches.sum()) - np.repeat(match_starts, n_matches)
+    cluster_idx = cluster_order[position]
+
+    matched = {}
+    for field in cluster_data.fields:
+        matched[field] = _flat(cluster_data[field])[cluster_idx]
+    for field in muon_data.fields:
+        matched[field] = _flat(muon_data[field])[muon_idx]
+    return matched
+
+#Sparse hit counter keyed by (chamber index, expanded pad, BX). Only populated cells are stored, as sorted
+#int64 keys with their int64 counts, so the memory scales with the data rather than the detector binning.
+class hitAccumulator():
+    def __init__(self, compact_size=5000000):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.compact_size = compact_size #Number of buffered hits/cells before they are folded into keys/counts
+        self._pending_hits = []
+        self._pending_cells = []
+        self._pending_size = 0
+
+    def encode(self, chamber_idx, pads, bxs):
+        bxs = np.clip(np.asarray(bxs, dtype=np.int64) + BX_OFFSET, 0, BX_SPAN - 1)
+        pads = np.clip(np.asarray(pads, dtype=np.int64) + 1, 0, PAD_SPAN - 1)
+        return (np.asarray(chamber_idx, dtype=np.int64)*PAD_SPAN + pads)*BX_SPAN + bxs
+
+    def decode(self, keys):
+        bxs = keys % BX_SPAN - BX_OFFSET
+        pads = (keys // BX_SPAN) % PAD_SPAN - 1
+        chamber_idx = keys // (BX_SPAN*PAD_SPAN)
+        return chamber_idx, pads, bxs
+
+    #Adds one count per (pad, bx) pair in the given chamber(s)
+    def fill(self, chamber_idx, pads, bxs):
+        if len(pads)==0:
+            return
+        self._pending_hits.append(self.encode(chamber_idx, pads, bxs))
+        self._pending_size += len(pads)
+        if self._pending_size >= self.compact_size:
+            self.compact()
+
+    #Adds already-counted cells (e.g. the partial result of another accumulator)
+    def fill_counts(self, keys, counts):
+        if len(keys)==0:
+            return
+        self._pending_cells.append((np.asarray(keys, dtype=np.int64), np.asarray(counts, dtype=np.int64)))
+        self._pending_size += len(keys)
+        if self._pending_size >= self.compact_size:
+            self.compact()
+
+    def merge(self, other):
+        other.compact()
+        self.fill_counts(other.keys, other.counts)
+
+    def compact(self):
+        if not self._pending_hits and not self._pending_cells:
+            return
+
+        all_cells = [(self.keys, self.counts)] + self._pending_cells
+        if self._pending_hits:
+            hit_keys, hit_counts = np.unique(np.concatenate(self._pending_hits), return_counts=True)
+            all_cells.append((hit_keys, hit_counts.astype(np.int64)))
+
+        self._pending_hits = []
+        self._pending_cells = []
+        self._pending_size = 0
+
+        merged_keys, inverse = np.unique(np.concatenate([keys for keys, _ in all_cells]), return_inverse=True)
+        merged_counts = np.zeros(len(merged_keys), dtype=np.int64)
+        np.add.at(merged_counts, inverse, np.concatenate([counts for _, counts in all_cells]))
+        self.keys, self.counts = merged_keys, merged_counts
+
+    #Sparse partial output (e.g. one shard of a run); extra metadata is stored as JSON next to the counts
+    def save(self, path, **metadata):
+        self.compact()
+        temp_path = path+".tmp.npz"
+        np.savez(temp_path, keys=self.keys, counts=self.counts, metadata=json.dumps(metadata))
+        os.replace(temp_path, path)
+
+    #Adds the counts stored by save() and returns their metadata
+    def load(self, path):
+        with np.load(path) as partial:
+            self.fill_counts(partial["keys"], partial["counts"])
+            return json.loads(str(partial["metadata"]))
+
+    def chamber_cells(self, chamber_idx):
+        self.compact()
+        first = chamber_idx*PAD_SPAN*BX_SPAN
+        lo, hi = np.searchsorted(self.keys, [first, first + PAD_SPAN*BX_SPAN])
+        _, pads, bxs = self.decode(self.keys[lo:hi])
+        return pads, bxs, self.counts[lo:hi]
+
+    #Expands the sparse counts of one chamber into the 1/120 BX ROOT histogram
+    def to_hist(self, chamber_idx):
+        pads, bxs, counts = self.chamber_cells(chamber_idx)
+        return fill_mcdonalds_hist(make_mcdonalds_hist(chamber_names[chamber_idx]), pads + 1, bxs, counts)
+
+#Splits the ntuple files into (file, entry_start, entry_stop) tasks. Files are sorted so the split is deterministic,
+#large files are cut into several tasks, and max_entries truncates the run (used by -l/--limit).
+def make_tasks(filelist, max_task_entries=1000000, max_entries=None):
+    tasks = []
+    total_entries = 0
+    for file_path in sorted(filelist):
+        with uproot.open(file_path) as f:
+            num_entries = f[tree_name].num_entries
+
+        if max_entries is not None:
+            num_entries = min(num_entries, max_entries - total_entries)
+            if num_entries <= 0:
+                break
+
+        for entry_start in range(0, num_entries, max_task_entries):
+            tasks.append({
+                            "file": file_path, 
+                            "entry_start": entry_start, 
+                            "entry_stop": min(entry_start + max_task_entries, num_entries)
+                        })
+        total_entries += num_entries
+    return tasks
+
+#Stable name of a (file, entry_start, entry_stop) task, used for its checkpoint and matched-hit cache files
+def task_id(task):
+    return hashlib.sha1(f"{task['file']}:{task['entry_start']}:{task['entry_stop']}".encode()).hexdigest()[:16]
+
+#Deterministic slice i of N of the run: the global entry range [i*E/N, (i+1)*E/N) cut out of the task list,
+#so N batch jobs together cover every entry exactly once. Shards are numbered from 0.
+def shard_tasks(tasks, shard_index, n_shards):
+    if not 0 <= shard_index < n_shards:
+        raise ValueError(f"Shard {shard_index}/{n_shards} does not exist; shards are numbered 0 to {n_shards-1}")
+
+    total_entries = sum(task["entry_stop"] - task["entry_start"] for task in tasks)
+    shard_start = (shard_index*total_entries)//n_shards
+    shard_stop = ((shard_index + 1)*total_entries)//n_shards
+
+    shard = []
+    global_start = 0
+    for task in tasks:
+        global_stop = global_start + task["entry_stop"] - task["entry_start"]
+        overlap_start = max(global_start, shard_start)
+        overlap_stop = min(global_stop, shard_stop)
+        if overlap_start < overlap_stop:
+            shard.append({
+                            "file": task["file"], 
+                            "entry_start": task["entry_start"] + overlap_start - global_start, 
+                            "entry_stop": task["entry_start"] + overlap_stop - global_start
+                        })
+        global_start = global_stop
+    return shard
+
+def parse_shard(shard_string):
+    shard_index, n_shards = shard_string.split("/")
+    return int(shard_index), int(n_shards)
+
+def shard_path(output_baseName, shard_index, n_shards):
+    return os.path.join(output_baseName, "shards", f"shard_{shard_index}_of_{n_shards}.npz")
+
+#Writes the run's McDonalds store (see mcdonaldsStore.py) and, if asked, the old one-.root-file-per-chamber outputs
+def write_mcdonalds_outputs(hits, output_baseName, root_files=False):
+    hits.compact()
+    _, _, all_bxs = hits.decode(hits.keys)
+    bx_min, bx_max = (int(all_bxs.min()), int(all_bxs.max())) if len(all_bxs) else (0, 0)
+
+    def chamber_cells():
+        for idx in range(N_CHAMBERS):
+            pads, bxs, counts = hits.chamber_cells(idx)
+            yield chamber_names[idx], pads + 1, bxs, counts
+
+    write_store(output_baseName, chamber_cells(), bx_min, bx_max)
+
+    if root_files:
+        for idx in range(N_CHAMBERS):
+            chamber_hist = hits.to_hist(idx)
+            chamber_hist.SaveAs(output_baseName+chamber_names[idx]+".root")
+
+#Turns ntuple chunks into McDonalds hit counts. Holds only the settings so it can be shipped to worker processes.
+class mcdonaldsProducer():
+    def __init__(self, memory_budget_mb=500, CSCConstants_LCT_CENTRAL_BX=8, tmbL1aWindowSize=7, proximity=5, pt_min=10, 
+                    cache_dir=None, cache_pt_min=5, cache_proximity=10, prefetch=1):
+        #Memory for the chunks of events of one process (see ntupleReader) and the number of chunks read ahead on a
+        #background thread (see chunkPrefetcher); the counts depend on neither
+        self.memory_budget_mb = memory_budget_mb
+        self.prefetch = prefetch
+        self.CSCConstants_LCT_CENTRAL_BX = CSCConstants_LCT_CENTRAL_BX
+        self.tmbL1aWindowSize = tmbL1aWindowSize
+        self.proximity = proximity
+        self.pt_min = pt_min
+
+        #The matched-hit cache is written with looser cuts so that the pT/proximity cuts can be re-tuned from it later
+        self.cache_dir = cache_dir
+        self.cache_pt_min = min(cache_pt_min, pt_min)
+        self.cache_proximity = max(cache_proximity, proximity)
+
+    #Everything that changes the counts (used to validate checkpoints)
+    def settings(self):
+        return {
+                "CSCConstants_LCT_CENTRAL_BX": self.CSCConstants_LCT_CENTRAL_BX, 
+                "tmbL1aWindowSize": self.tmbL1aWindowSize, 
+                "proximity": self.proximity, 
+                "pt_min": self.pt_min
+            }
+
+    #Cuts used while reading/matching: the fill cuts, or the looser cache cuts when a cache is written
+    def read_cuts(self):
+        if self.cache_dir is None:
+            return self.pt_min, self.proximity
+        return self.cache_pt_min, self.cache_proximity
+
+    #Per-muon selection (jagged boolean mask). Events without any selected muon are dropped before the clusters are read.
+    def muon_mask(self, muon_data):
+        pt_min, _ = self.read_cuts()
+        return (
+                    (muon_data['mu_propagated_isME11']) 
+                    & (muon_data['mu_propagated_station']==1) 
+                    & (muon_data['mu_propagated_region']*muon_data['mu_propagated_Outermost_z']>0) 
+                    & (muon_data['mu_propagated_etaP']>=1) 
+                    & (muon_data['mu_propagated_etaP']<=8) 
+                    & (muon_data['mu_propagated_pt']>pt_min)
+                )
+
+    #muon_data/cluster_data only hold the surviving events (and muons), see ntupleReader.
+    #Returns the compact matched hit table of the chunk. The matching and filling times go to times (a stageTimes).
+    def process_chunk(self, muon_data, cluster_data, hits, times=None):
+        if times is None:
+            times = stageTimes()
+        _, proximity = self.read_cuts()
+
+        with times.stage("matching"):
+            table = self.match_chunk(muon_data, cluster_data, proximity)
+
+        with times.stage("filling"):
+            self.fill_table(table, hits)
+        return table
+
+    def match_chunk(self, muon_data, cluster_data, proximity):
+        #One row per matched (muon, cluster) pair
+        matched = match_clusters(muon_data, cluster_data, proximity=proximity)
+
+        #Route every matched cluster to its chamber with one composite key instead of a mask per chamber
+        hist_chamber_idx, hist_valid = route_clusters(
+                                            matched['gemPadDigiCluster_station'], 
+                                            matched['gemPadDigiCluster_region'], 
+                                            matched['gemPadDigiCluster_chamber'], 
+                                            matched['gemPadDigiCluster_layer']
+                                        )
+
+        #pT and strip are kept in float64 (exact for the float32 branches), so the cuts in select_table give the same
+        #answer as the ones in muon_mask/match_clusters, also for values right at a cut and when read back from the cache
+        table = {
+                    "chamber_idx": hist_chamber_idx[hist_valid].astype(np.int16), 
+                    "firstPad": matched['gemPadDigiCluster_ClusterFirstPad'][hist_valid].astype(np.int16), 
+                    "size": matched['gemPadDigiCluster_PadClusterSize'][hist_valid].astype(np.int16), 
+                    "etaPartition": matched['gemPadDigiCluster_etaPartition'][hist_valid].astype(np.int8), 
+                    "PadBX": matched['gemPadDigiCluster_PadBX'][hist_valid].astype(np.int16), 
+                    "ALCTMatchTime": matched['gemPadDigiCluster_ClusterALCTMatchTime'][hist_valid].astype(np.int16), 
+                    "muon_pt": matched['mu_propagated_pt'][hist_valid].astype(np.float64), 
+                    "muon_strip": matched['mu_propagated_strip'][hist_valid].astype(np.float64)
+                }
+        return table
+
+    #Applies the pT and proximity cuts to a matched hit table (no-op when it was made with the same cuts).
+    #The comparisons are done in float64 like the awkward cuts, also for caches written with float32 columns.
+    def select_table(self, table):
+        muon_pt = table["muon_pt"].astype(np.float64)
+        muon_pad = np.floor(table["muon_strip"].astype(np.float64)/2.0)
+        mask = (
+                    (muon_pt > self.pt_min) 
+                    & (np.abs(table["firstPad"] - muon_pad) <= self.proximity)
+                )
+        return {column: values[mask] for column, values in table.items()}
+
+    def fill_table(self, table, hits):
+        table = self.select_table(table)
+        cluster_sizes = table["size"]
+
+        expanded_pads, expanded_bxs = expand_clusters(
+                                        table["firstPad"], 
+                                        cluster_sizes, 
+                                        table["etaPartition"], 
+                                        table["PadBX"], 
+                                        table["ALCTMatchTime"], 
+                                        self.CSCConstants_LCT_CENTRAL_BX, 
+                                        self.tmbL1aWindowSize
+                                    )
+
+        expanded_chamber_idx = np.repeat(table["chamber_idx"].astype(np.int64), np.maximum(cluster_sizes, 0))
+        hits.fill(expanded_chamber_idx, expanded_pads, expanded_bxs)
+
+    def cache_path(self, task):
+        return os.path.join(self.cache_dir, task_id(task)+".npz")
+
+    #Returns the hits of the task and its metrics: the reading/matching/filling times and one record per chunk.
+    #progress (optional) is called with the number of entries of the task done so far after every chunk.
+    def process_task(self, task, progress=None):
+        hits = hitAccumulator()
+        tables = []
+        times = stageTimes()
+        chunk_records = []
+        with uproot.open(task["file"]) as f:
+            reader = ntupleReader(f[tree_name], self.muon_mask, memory_budget_mb=self.memory_budget_mb, prefetch=self.prefetch)
+            chunks = reader.chunks(task["entry_start"], task["entry_stop"])
+            #Reading includes the muon selection and the decompression of the selected cluster baskets. With prefetching
+            #it runs on a background thread and only the time spent waiting for it counts here.
+            read_stage = "reading"
+            if self.prefetch > 0:
+                chunks = chunkPrefetcher(chunks, depth=self.prefetch)
+                read_stage = "waiting for reads"
+            try:
+                while True:
+                    with times.stage(read_stage):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+
+                    chunk_start, chunk_stop, muon_data, cluster_data = chunk
+                    table = self.process_chunk(muon_data, cluster_data, hits, times=times)
+                    chunk_records.append({
+                                            "entry_start": chunk_start, 
+                                            "entry_stop": chunk_stop, 
+                                            "selected_events": len(muon_data), 
+                                            "data_mb": (muon_data.nbytes + cluster_data.nbytes)/(1024*1024), 
+                                            "matched_clusters": len(table["chamber_idx"])
+                                        })
+                    if self.cache_dir is not None:
+                        tables.append(table)
+                    if progress is not None:
+                        progress(chunk_stop - task["entry_start"])
+                    del chunk, muon_data, cluster_data
+            finally:
+                if self.prefetch > 0:
+                    chunks.close()
+                    times.merge(chunks.times.stages)
+
+        if self.cache_dir is not None:
+            with times.stage("matched cache"):
+                save_matched_cache(self.cache_path(task), tables, task, self.cache_pt_min, self.cache_proximity)
+
+        with times.stage("filling"):
+            hits.compact()
+        return hits, {"stages": times.stages, "chunks": chunk_records, "peak_rss_mb": peak_rss_mb()}
+
+    #Rebuilds the counts from the matched-hit cache files of the given tasks without touching the ntuples
+    def rebuild_from_cache(self, tasks):
+        hits = hitAccumulator()
+        for task in tasks:
+            path = self.cache_path(task)
+            if not os.path.exists(path):
+                raise ValueError(f"No matched-hit cache for {task['file']} [{task['entry_start']}, {task['entry_stop']}); rerun with --cache first!")
+
+            table, metadata = load_matched_cache(path)
+            if self.pt_min < metadata["cache_pt_min"] or self.proximity > metadata["cache_proximity"]:
+                raise ValueError(
+                    f"The cache was made with pt > {metadata['cache_pt_min']} and proximity <= {metadata['cache_proximity']}; "
+                    f"it cannot be used for pt > {self.pt_min} and proximity <= {self.proximity}"
+                )
+            self.fill_table(table, hits)
+        hits.compact()
+        return hits
+
+#Matched hit table of one task as a compressed columnar .npz (one array per column)
+def save_matched_cache(path, tables, task, cache_pt_min, cache_proximity):
+    columns = {}
+    if tables:
+        for column in tables[0].keys():
+            columns[column] = np.concatenate([table[column] for table in tables])
+
+    metadata = {"task": task, "cache_pt_min": cache_pt_min, "cache_proximity": cache_proximity}
+    temp_path = path+".tmp.npz"
+    np.savez_compressed(temp_path, metadata=json.dumps(metadata), **columns)
+    os.replace(temp_path, path)
+
+def load_matched_cache(path):
+    with np.load(path) as cache:
+        metadata = json.loads(str(cache["metadata"]))
+        table = {column: cache[column] for column in cache.files if column != "metadata"}
+    if not table:
+        table = {
+                    "chamber_idx": np.zeros(0, dtype=np.int16), 
+                    "firstPad": np.zeros(0, dtype=np.int16), 
+                    "size": np.zeros(0, dtype=np.int16), 
+                    "etaPartition": np.zeros(0, dtype=np.int8), 
+                    "PadBX": np.zeros(0, dtype=np.int16), 
+                    "ALCTMatchTime": np.zeros(0, dtype=np.int16), 
+                    "muon_pt": np.zeros(0, dtype=np.float64), 
+                    "muon_strip": np.zeros(0, dtype=np.float64)
+                }
+    return table, metadata
+
+#Estimated uncompressed bytes of the given branches before every boundary (linear in between). The basket sizes come
+#from the TBranch metadata (compressed bytes times the compression ratio of the branch), so nothing is read for this.
+def basket_bytes_profile(tree, variables, boundaries):
+    cumulative = np.zeros(len(boundaries))
+    for variable in variables:
+        branch = tree[variable]
+        ratio = branch.uncompressed_bytes/max(branch.compressed_bytes, 1)
+        basket_bytes = np.array([branch.basket_compressed_bytes(i) for i in range(branch.num_baskets)], dtype=np.float64)*ratio
+        cumulative += np.interp(boundaries, np.asarray(branch.entry_offsets, dtype=np.float64), np.concatenate([[0.0], np.cumsum(basket_bytes)]))
+    return cumulative
+
+#Reads the ntuple in two phases: the cheap muon branches of a chunk first, then the heavy gemPadDigiCluster_* branches
+#only for the baskets that contain events passing the muon selection. Rejected stretches of the tree are never
+#decompressed for the cluster branches.
+#The chunks are sized to a memory budget instead of a fixed number of events. The bytes of every stretch of the tree
+#are known from its basket sizes, and these estimates are corrected after every chunk with what was actually read
+#(the bytes per event and the fraction of the cluster bytes that belongs to selected events). A chunk whose selected
+#events still turn out to need more than the budget is split before its clusters are read.
+class ntupleReader():
+    def __init__(self, tree, muon_mask, memory_budget_mb=500, min_step=1000, prefetch=0):
+        self.tree = tree
+        self.muon_mask = muon_mask
+        self.min_step = min_step
+        #Bytes that may be read for one chunk. The chunk being matched and filled needs about CHUNK_MEMORY_FACTOR times
+        #that; with prefetching, the chunks waiting in the queue and the one being read are held as well.
+        chunks_in_memory = CHUNK_MEMORY_FACTOR + (prefetch + 1 if prefetch > 0 else 0)
+        self.chunk_bytes = memory_budget_mb*1024*1024/chunks_in_memory
+        #Basket boundaries of the cluster branches (all cluster branches are filled together)
+        self.cluster_offsets = np.asarray(tree[cluster_variables[0]].entry_offsets, dtype=np.int64)
+
+        self.boundaries = np.unique(np.concatenate([np.asarray(tree[variable].entry_offsets, dtype=np.int64) for variable in variables]))
+        self.muon_cumulative = basket_bytes_profile(tree, muon_variables, self.boundaries)
+        self.cluster_cumulative = basket_bytes_profile(tree, cluster_variables, self.boundaries)
+
+        #Observed/estimated muon bytes, observed/estimated cluster bytes of the selected events and the estimated fraction
+        #of the cluster bytes that belongs to selected events. Until the first chunk, every event counts as selected.
+        self.muon_scale = 1.0
+        self.cluster_scale = 1.0
+        self.selected_fraction = 1.0
+
+    def estimated_bytes(self, cumulative, entries):
+        return np.interp(entries, self.boundaries, cumulative)
+
+    #Estimated cluster bytes of each of the given entries
+    def cluster_bytes_per_entry(self, entries):
+        segment = np.clip(np.searchsorted(self.boundaries, entries, side='right') - 1, 0, len(self.boundaries) - 2)
+        return np.diff(self.cluster_cumulative)[segment]/np.maximum(np.diff(self.boundaries)[segment], 1)
+
+    #End of the largest chunk from chunk_start whose estimated bytes fit in the budget
+    def chunk_stop(self, chunk_start, entry_stop):
+        cumulative = self.muon_scale*self.muon_cumulative + self.selected_fraction*self.cluster_scale*self.cluster_cumulative
+        target = self.estimated_bytes(cumulative, chunk_start) + self.chunk_bytes
+        stop = int(np.interp(target, cumulative, self.boundaries))
+        return min(max(stop, chunk_start + self.min_step), entry_stop)
+
+    #Yields (chunk start, chunk stop, selected muons, their clusters); chunks without any selected muon are skipped
+    def chunks(self, entry_start, entry_stop):
+        chunk_start = entry_start
+        while chunk_start < entry_stop:
+            chunk_stop = self.chunk_stop(chunk_start, entry_stop)
+            muon_data = self.tree.arrays(muon_variables, entry_start=chunk_start, entry_stop=chunk_stop, library='ak')
+            estimated_muon_bytes = self.estimated_bytes(self.muon_cumulative, chunk_stop) - self.estimated_bytes(self.muon_cumulative, chunk_start)
+            self.muon_scale = 0.5*(self.muon_scale + muon_data.nbytes/max(estimated_muon_bytes, 1))
+
+            muon_mask = self.muon_mask(muon_data)
+            keep = ak.to_numpy(ak.any(muon_mask, axis=1))
+            selected_muons = muon_data[muon_mask][keep]
+            del muon_data, muon_mask
+
+            entries = chunk_start + np.flatnonzero(keep)
+            estimated_cluster_bytes = self.cluster_bytes_per_entry(entries)
+            all_cluster_bytes = self.estimated_bytes(self.cluster_cumulative, chunk_stop) - self.estimated_bytes(self.cluster_cumulative, chunk_start)
+            self.selected_fraction = 0.5*(self.selected_fraction + estimated_cluster_bytes.sum()/max(all_cluster_bytes, 1))
+
+            #Pieces of the selected events that each fit in the budget (one piece unless the estimate was too low)
+            piece = (np.cumsum(estimated_cluster_bytes)*self.cluster_scale//self.chunk_bytes).astype(np.int64)
+            piece_breaks = np.concatenate([[0], np.flatnonzero(np.diff(piece)) + 1, [len(entries)]])
+            read_bytes = 0
+            for lo, hi in zip(piece_breaks[:-1], piece_breaks[1:]):
+                if lo == hi:
+                    continue
+                cluster_data = self.read_clusters(entries[lo:hi])
+                read_bytes += cluster_data.nbytes
+                piece_start = chunk_start if lo == 0 else int(entries[lo])
+                piece_stop = chunk_stop if hi == len(entries) else int(entries[hi])
+                yield piece_start, piece_stop, selected_muons[lo:hi], cluster_data
+                del cluster_data
+
+            if len(entries) > 0:
+                self.cluster_scale = 0.5*(self.cluster_scale + read_bytes/max(estimated_cluster_bytes.sum(), 1))
+            chunk_start = chunk_stop
+
+    #Reads the cluster branches for the given (sorted, absolute) entries, one contiguous run of baskets at a time
+    def read_clusters(self, entries):
+        baskets = np.unique(np.searchsorted(self.cluster_offsets, entries, side='right') - 1)
+        run_breaks = np.flatnonzero(np.diff(baskets) != 1) + 1
+
+        pieces = []
+        for basket_run in np.split(baskets, run_breaks):
+            span_start = max(int(self.cluster_offsets[basket_run[0]]), int(entries[0]))
+            span_stop = min(int(self.cluster_offsets[basket_run[-1] + 1]), int(entries[-1]) + 1)
+            span_entries = entries[(entries >= span_start) & (entries < span_stop)]
+
+            span_data = self.tree.arrays(cluster_variables, entry_start=span_start, entry_stop=span_stop, library='ak')
+            pieces.append(span_data[span_entries - span_start])
+
+        if len(pieces)==1:
+            return pieces[0]
+        return ak.concatenate(pieces)
+
+#Runs a chunk generator (ntupleReader.chunks) on a background thread, so that the next chunks are read and decompressed
+#while the current one is matched and filled; the file reads and the decompression mostly release the GIL. At most
+#depth finished chunks wait in the queue. An exception of the reader is raised again in the consumer.
+class chunkPrefetcher():
+    _finished = object()
+
+    def __init__(self, chunks, depth=1):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopping = threading.Event()
+        self.done = False
+        #Wall and CPU time of the background thread itself
+        self.times = stageTimes()
+        self.thread = threading.Thread(target=self._read, args=(chunks,), daemon=True)
+        self.thread.start()
+
+    def _read(self, chunks):
+        try:
+            while not self.stopping.is_set():
+                wall_start, cpu_start = time.perf_counter(), time.thread_time()
+                chunk = next(chunks, self._finished)
+                self.times.add("reading", time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+                self._put((chunk, None))
+                if chunk is self._finished:
+                    return
+        except BaseException as error:
+            self._put((self._finished, error))
+        finally:
+            chunks.close()
+
+    #Waits for room in the queue, unless the consumer has stopped
+    def _put(self, entry):
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        chunk, error = self.queue.get()
+        if chunk is self._finished:
+            self.done = True
+            if error is not None:
+                raise error
+            raise StopIteration
+        return chunk
+
+    #Stops the background thread (after the chunk it is reading) and drops the chunks still in the queue
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.done = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+#Per-run manifest of finished tasks plus the sparse partial counts of each one, so a crashed or extended run only
+#processes the files that are new or changed since the last time. A file is "changed" when its size or mtime differs.
+class checkpointStore():
+    def __init__(self, directory, settings, fresh=False):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.settings = settings
+        os.makedirs(directory, exist_ok=True)
+
+        self.manifest = {"settings": settings, "tasks": {}}
+        if fresh:
+            for name in os.listdir(directory):
+                if name.endswith(".npz"):
+                    os.remove(os.path.join(directory, name))
+
+        elif os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            #Different cuts/constants mean different counts, so nothing from before can be reused
+            if manifest.get("settings") == settings:
+                self.manifest = manifest
+            else:
+                print("\033[93mThe checkpoint settings changed; reprocessing every file.\033[0m")
+
+    def file_signature(self, file_path):
+        stat = os.stat(file_path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def partial_path(self, task):
+        return os.path.join(self.directory, task_id(task)+".npz")
+
+    def is_done(self, task):
+        entry = self.manifest["tasks"].get(task_id(task))
+        return (
+                entry is not None 
+                and entry["file"] == task["file"] 
+                and entry["entry_start"] == task["entry_start"] 
+                and entry["entry_stop"] == task["entry_stop"] 
+                and entry["signature"] == self.file_signature(task["file"]) 
+                and os.path.exists(self.partial_path(task))
+            )
+
+    def load(self, task):
+        with np.load(self.partial_path(task)) as partial:
+            return partial["keys"], partial["counts"]
+
+    def save(self, task, keys, counts):
+        #Write to a temporary file first so that a crash never leaves a half-written partial or manifest behind
+        temp_path = self.partial_path(task)+".tmp.npz"
+        np.savez(temp_path, keys=keys, counts=counts)
+        os.replace(temp_path, self.partial_path(task))
+
+        self.manifest["tasks"][task_id(task)] = {
+                                                    "file": task["file"], 
+                                                    "entry_start": task["entry_start"], 
+                                                    "entry_stop": task["entry_stop"], 
+                                                    "entries_processed": task["entry_stop"] - task["entry_start"], 
+                                                    "signature": self.file_signature(task["file"])
+                                                }
+        self.write_manifest()
+
+    def write_manifest(self):
+        temp_path = self.manifest_path+".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    #Forgets tasks that are no longer part of the run (e.g. removed files or a different -l)
+    def prune(self, tasks):
+        keep = set(task_id(task) for task in tasks)
+        for old_id in list(self.manifest["tasks"].keys()):
+            if old_id not in keep:
+                del self.manifest["tasks"][old_id]
+                partial = os.path.join(self.directory, old_id+".npz")
+                if os.path.exists(partial):
+                    os.remove(partial)
+        self.write_manifest()
+
+#Tasks recorded in a checkpoint manifest (used to rebuild from the matched-hit cache without opening the ntuples)
+def manifest_tasks(directory):
+    manifest_path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(manifest_path):
+        raise ValueError(f"No checkpoint manifest in {directory}; run the producer with --cache first!")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    tasks = [
+                {"file": entry["file"], "entry_start": entry["entry_start"], "entry_stop": entry["entry_stop"]} 
+                for entry in manifest["tasks"].values()
+            ]
+    return sorted(tasks, key=lambda task: (task["file"], task["entry_start"]))
+
+#Worker entry point: only the sparse keys/counts (and the task metrics) travel back to the parent process, never histograms
+def _process_task_worker(producer, task):
+    hits, task_metrics = producer.process_task(task)
+    return hits.keys, hits.counts, task_metrics
+
+#Runs all the tasks (serially for n_jobs=1, otherwise on a process pool) and reduces them into one accumulator.
+#Integer counts are summed, so the result does not depend on n_jobs or on the order the tasks finish in.
+#With a checkpointStore, finished tasks are loaded from disk and every newly finished task is saved right away.
+#With a runMetrics, the stage times of every task and a record per chunk and per task are added to the run's metrics.
+def run_tasks(producer, tasks, n_jobs=1, checkpoints=None, metrics=None):
+    hits = hitAccumulator()
+    processed_entries = 0
+    total_entries = sum(task["entry_stop"] - task["entry_start"] for task in tasks)
+
+    todo = tasks
+    if checkpoints is not None:
+        checkpoints.prune(tasks)
+        todo = []
+        for task in tasks:
+            cache_missing = producer.cache_dir is not None and not os.path.exists(producer.cache_path(task))
+            if checkpoints.is_done(task) and not cache_missing:
+                hits.fill_counts(*checkpoints.load(task))
+                processed_entries += task["entry_stop"] - task["entry_start"]
+            else:
+                todo.append(task)
+        print(f"Reusing {len(tasks)-len(todo)} checkpointed tasks; {len(todo)} tasks left to process")
+
+    #The total comes from the entry counts in the file metadata (make_tasks), so the ETA covers the whole run
+    progress = progressLine(total_entries, done=processed_entries, unit="events")
+    progress.update(processed_entries, force=True)
+
+    def task_done(task, keys, counts, task_metrics):
+        nonlocal processed_entries
+        if checkpoints is not None:
+            checkpoints.save(task, keys, counts)
+        hits.fill_counts(keys, counts)
+        processed_entries += task["entry_stop"] - task["entry_start"]
+        progress.update(processed_entries)
+
+        if metrics is not None:
+            metrics.times.merge(task_metrics["stages"])
+            for chunk in task_metrics["chunks"]:
+                metrics.record("chunk", file=task["file"], **chunk)
+            selected_events = sum(chunk["selected_events"] for chunk in task_metrics["chunks"])
+            matched_clusters = sum(chunk["matched_clusters"] for chunk in task_metrics["chunks"])
+            metrics.record(
+                            "task", 
+                            file=task["file"], 
+                            entry_start=task["entry_start"], 
+                            entry_stop=task["entry_stop"], 
+                            selected_events=selected_events, 
+                            matched_clusters=matched_clusters, 
+                            stages=task_metrics["stages"], 
+                            peak_rss_mb=task_metrics["peak_rss_mb"]
+                        )
+            metrics.count("events", task["entry_stop"] - task["entry_start"])
+            metrics.count("selected_events", selected_events)
+            metrics.count("matched_clusters", matched_clusters)
+
+    if n_jobs <= 1:
+        for task in todo:
+            done_before = processed_entries
+            task_hits, task_metrics = producer.process_task(task, progress=lambda done: progress.update(done_before + done))
+            task_done(task, task_hits.keys, task_hits.counts, task_metrics)
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(_process_task_worker, producer, task): task for task in todo}
+            for future in concurrent.futures.as_completed(futures):
+                task_done(futures[future], *future.result())
+
+    progress.finish()
+    hits.compact()
+    return hits
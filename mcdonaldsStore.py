@@ -0,0 +1,102 @@
+#The per-run McDonalds store: the hand-off between generate_mcdonalds_plots.py and run.py.
+#All the non-empty chambers of a run live in one integer cube (chamber slot x pad bin x BX) saved as a .npy file,
+#with a small JSON index of chamber names. The cube is memory-mapped, so a chamber's matrix is read without copying
+#and empty chambers are never touched. The 1/120 BX ROOT histograms are made from it on demand.
+#Code by Jacob Steenis, 2024/2025
+import json
+import os
+import numpy as np
+import ROOT
+
+N_PAD_BINS = 1536 + 2 #Expanded pads plus the under/overflow bins, exactly like the ROOT x-axis
+
+STORE_CUBE = "mcdonalds_store.npy"
+STORE_INDEX = "mcdonalds_store.json"
+
+#Empty McDonalds histogram with the standard binning (bins are centered at integers or 1/120 of an integer)
+def make_mcdonalds_hist(hist_name):
+    hist = ROOT.TH2D(
+                        hist_name,
+                        hist_name,
+                        int(1536),
+                        -0.5,
+                        1535.5,
+                        24*120,
+                        0-0.004166666666666666-0.5,
+                        24-0.004166666666666666-0.5
+                    )
+    hist.GetXaxis().SetTitle("Expanded Pad ID")
+    hist.GetYaxis().SetTitle("Time [bx]")
+    hist.SetDirectory(0)
+    return hist
+
+#Adds integer counts at (pad x-bin, integer BX) into a McDonalds histogram, in bulk
+def fill_mcdonalds_hist(hist, xbins, bxs, counts):
+    if len(counts)==0:
+        return hist
+
+    nx = hist.GetNbinsX()
+    unique_bxs, bx_inverse = np.unique(bxs, return_inverse=True)
+    ybins = np.array([hist.GetYaxis().FindBin(bx) for bx in unique_bxs.tolist()], dtype=np.int64)[bx_inverse]
+
+    contents = np.frombuffer(hist.GetArray(), dtype=np.float64, count=hist.GetNcells())
+    np.add.at(contents, ybins*(nx + 2) + np.asarray(xbins, dtype=np.int64), counts)
+    hist.SetEntries(hist.GetEntries() + float(np.sum(counts)))
+    return hist
+
+#Writes the store. chamber_cells is an iterable of (chamber name, pad x-bins, BXs, counts) for the non-empty chambers.
+def write_store(directory, chamber_cells, bx_min, bx_max):
+    chamber_cells = [cells for cells in chamber_cells if len(cells[3]) > 0]
+    n_bx = bx_max - bx_min + 1
+
+    #Write to temporary files first so that a crash never leaves a half-written store behind
+    cube_path = os.path.join(directory, STORE_CUBE)
+    temp_cube_path = cube_path+".tmp.npy"
+    cube = np.lib.format.open_memmap(temp_cube_path, mode="w+", dtype=np.int32, shape=(len(chamber_cells), N_PAD_BINS, n_bx))
+
+    index = {"bx_min": int(bx_min), "n_bx": int(n_bx), "chambers": {}}
+    for slot, (name, xbins, bxs, counts) in enumerate(chamber_cells):
+        cube[slot] = 0
+        cube[slot][xbins, bxs - bx_min] = counts
+        index["chambers"][name] = {"slot": slot, "entries": int(np.sum(counts))}
+
+    cube.flush()
+    del cube
+    os.replace(temp_cube_path, cube_path)
+
+    index_path = os.path.join(directory, STORE_INDEX)
+    with open(index_path+".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path+".tmp", index_path)
+    print(f"Output {index_path} made! ({len(chamber_cells)} non-empty chambers)")
+
+def store_exists(directory):
+    return os.path.exists(os.path.join(directory, STORE_INDEX)) and os.path.exists(os.path.join(directory, STORE_CUBE))
+
+#Read side of the store (used by run.py)
+class mcdonaldsStore():
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, STORE_INDEX)) as f:
+            self.index = json.load(f)
+        self.cube = np.load(os.path.join(directory, STORE_CUBE), mmap_mode="r")
+        self.bx_min = self.index["bx_min"]
+
+    #Only the non-empty chambers are in the index
+    def chamber_names(self):
+        return sorted(self.index["chambers"].keys())
+
+    def entries(self, name):
+        return self.index["chambers"][name]["entries"]
+
+    #Zero-copy (memory-mapped) pad-bin x BX count matrix of one chamber; column j is BX = bx_min + j
+    def matrix(self, name):
+        return self.cube[self.index["chambers"][name]["slot"]]
+
+    def bxs(self):
+        return np.arange(self.bx_min, self.bx_min + self.index["n_bx"])
+
+    def to_hist(self, name):
+        matrix = self.matrix(name)
+        xbins, bx_idx = np.nonzero(matrix)
+        return fill_mcdonalds_hist(make_mcdonalds_hist(name), xbins, bx_idx + self.bx_min, matrix[xbins, bx_idx])
@@ -0,0 +1,53 @@
+#This script combines the partial outputs of generate_mcdonalds_plots.py --shard i/N jobs into the usual
+#McDonalds histograms, exactly as if the whole run had been processed by a single job.
+
+#Code by Jacob Steenis, 2024/2025
+
+import ROOT
+import glob
+import argparse
+from setup import ensure_folders_exist
+from mcdonaldsClasses import *
+
+ROOT.gROOT.SetBatch(1)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', type=int, default=None, help='Process a single run number')
+    parser.add_argument('-n', '--num_shards', type=int, default=None, help='Number of shards the run was split into (found from the shard files if not given)')
+    parser.add_argument('--root', action='store_true', help='Also export the old one .root file per chamber next to the McDonalds store')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.run is not None:
+        output_baseName = f"GEM_mcdonalds_data/run{args.run}/"
+    else:
+        print("\nYOU ARE USING THE DEFAULT OPTION WHICH USES RUN 393240; PLEASE SPECIFCY A RUN WITH -r")
+        output_baseName = f"GEM_mcdonalds_data/default/"
+
+    shard_files = glob.glob(output_baseName+"shards/shard_*_of_*.npz")
+    n_shards = args.num_shards
+    if n_shards is None:
+        found = set(int(f.split("_of_")[-1].replace(".npz","")) for f in shard_files)
+        if len(found) != 1:
+            raise ValueError(f"Found shard files for several splittings {sorted(found)}; choose one with -n")
+        n_shards = found.pop()
+
+    hits = hitAccumulator()
+    settings = None
+    for shard_index in range(n_shards):
+        path = shard_path(output_baseName, shard_index, n_shards)
+        if not os.path.exists(path):
+            raise ValueError(f"Shard {shard_index}/{n_shards} is missing ({path}); it has to finish before merging!")
+
+        metadata = hits.load(path)
+        if settings is not None and metadata["settings"] != settings:
+            raise ValueError(f"Shard {shard_index}/{n_shards} was made with different settings: {metadata['settings']} vs {settings}")
+        settings = metadata["settings"]
+        print(f"Merged shard {shard_index}/{n_shards}: {len(metadata['tasks'])} tasks")
+
+    hits.compact()
+    write_mcdonalds_outputs(hits, output_baseName, root_files=args.root)
@@ -2,20 +2,84 @@
 #To look under the hood of the classes, look at the delayClasses script
 #Code by Jacob Steenis, 2024/2025
 from delayClasses import *
+from mcdonaldsStore import mcdonaldsStore, store_exists
 import glob
 import argparse
+import sys
+import functools
+import traceback
+import concurrent.futures
+import multiprocessing
 from setup import ensure_folders_exist
+from runMetrics import runMetrics, stageTimes, progressLine
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--run', type=int, default=None, help='Process a single run number')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes generating the chamber delays')
+    parser.add_argument('--fit_backend', type=str, default="root", choices=FIT_BACKENDS, help='Fit every pad group with its own ROOT TF1 fit (root) or all pad groups of a chamber at once (numpy)')
+    parser.add_argument('--columnar', action='store_true', help='Also write the delays of all chambers to delays/delays.npz (one array per column)')
+    parser.add_argument('--intermediate', action='store_true', help='Also write the fit information of every optimizer step to verification_plots/intermediate')
+    parser.add_argument('--optimizer', type=str, default="refit", choices=OPTIMIZERS, help='Score the reference point offsets by refitting the shifted histograms (refit) or from the initial fit means (analytic)')
+    parser.add_argument('--optimize_steps', type=int, default=None, help='Number of reference point offsets between 0 and 1 BX to try (default: 5 for refit, 120 for analytic)')
+    parser.add_argument('--fit_cache', type=str, default="fit_cache", help='Directory of the fit result cache')
+    parser.add_argument('--fit_cache_size', type=float, default=500, help='Maximum size of the fit result cache in MB')
+    fit_cache_mode = parser.add_mutually_exclusive_group()
+    fit_cache_mode.add_argument('--no_fit_cache', action='store_true', help='Fit everything without reading or writing the fit result cache')
+    fit_cache_mode.add_argument('--clear_fit_cache', action='store_true', help='Empty the fit result cache before running')
     args = parser.parse_args()
     return args
 
+# Generates the delays of one chamber and writes its delays .root file.
+# Returns (group delays, gbt delays, hot channels, chamber metrics), or None for an empty chamber.
+def process_chamber(input_file_name, store, fit_cache, options):
+    print("-------------------------------------------------------------------------------------------------------------")
+    print("\n\033[1;32mCurrently on file: \033[0m", input_file_name)
+    times = stageTimes()
+    with times.stage("loading"):
+        DR = dataRetriever(input_file_name, store=store)
+
+    with times.stage("delays"):
+        DG = delayGenerator(DR.histo, DR.histo_name, input_file_name, fit_cache=fit_cache, **options)
+
+    if DG.status == False:
+        return None
+
+    with times.stage("writing root"):
+        outfile = ROOT.TFile(f"{DG.baseName}/delays/{input_file_name.split('/')[-1].replace('.root','')}_delays.root", "RECREATE")
+        DG.histo.Write()
+
+        DG.float_applied_histo.Write()
+        DG.int_applied_histo.Write()
+        DG.gbt_applied_histo.Write()
+
+        DG.int_differences.Write("integer_differences")
+        DG.gbt_differences.Write("gbt_differences")
+
+        outfile.Close()
+    print("-------------------------------------------------------------------------------------------------------------\n")
+
+    # The fitting is part of the delays stage; it is also given on its own
+    times.add("fitting", DG.general.fit_stats["fit_seconds"], DG.general.fit_stats["fit_cpu_seconds"], DG.general.fit_stats["fits"])
+    chamber_metrics = {
+                        "chamber": DG.histo_name, 
+                        "stages": times.stages, 
+                        "hot_pads": sum(len(channels) for channels in DG.hotChannels.values()), 
+                        **DG.general.fit_stats
+                    }
+    return DG.group_df, DG.gbt_df, DG.hotChannels, chamber_metrics
+
+# Each worker process opens the McDonalds store and the fit cache once and keeps them for all its chambers
+_worker_state = {}
+
+def _process_chamber_worker(input_file_name, mcdonalds_dir, fit_cache_settings, options):
+    if "store" not in _worker_state:
+        _worker_state["store"] = mcdonaldsStore(mcdonalds_dir) if store_exists(mcdonalds_dir) else None
+        _worker_state["fit_cache"] = None if fit_cache_settings is None else fitCache(fit_cache_settings[0], max_size_mb=fit_cache_settings[1])
+    return process_chamber(input_file_name, _worker_state["store"], _worker_state["fit_cache"], options)
+
 if __name__ == '__main__':
     args = parse_args()
-    ensure_folders_exist("temp_canvas_images", [])
-
     subfolders = [
                     "delays",
                     "verification_plots",
@@ -25,90 +89,111 @@ if __name__ == '__main__':
                 ]
 
     if args.run is not None:
-        ensure_folders_exist(f"GEM_delays/run{args.run}", subfolders)
-        files = glob.glob(f"./GEM_mcdonalds_data/run{args.run}/*.root") #pull all files in the GEM_mcdonalds file for a specific run
+        baseName = f"GEM_delays/run{args.run}"
+        ensure_folders_exist(baseName, subfolders)
+        mcdonalds_dir = f"./GEM_mcdonalds_data/run{args.run}/" #pull all chambers in the GEM_mcdonalds file for a specific run
 
     else:
         print("\nYOU ARE USING THE DEFAULT OPTION WHICH USES RUN 393240; PLEASE SPECIFCY A RUN WITH -r")
-        ensure_folders_exist("GEM_delays/default", subfolders)
-        files = glob.glob("./GEM_mcdonalds_data/default/*.root") #pull all files in the GEM_mcdonalds file
-
-    all_hot_channels = {}
-    for i, input_file_name in enumerate(files): 
-        print("-------------------------------------------------------------------------------------------------------------")
-        print("\n\033[1;32mCurrently on file: \033[0m", input_file_name)
-        DR = dataRetriever(input_file_name)
-        original_histo = DR.histo
-    
-        # rebin_num = number of pads you consider together 
-        #       (8 pads = 1 group, whole group gets same correction)
-        #
-        # num_optimize_step = number of increments between 0 and 1 you add to your reference number when 
-        #       optimizing the differences from that reference number
-        #
-        # reference_point is the actual number you subtract the mean timing (per padID) to get estimates for
-        #       the delays needed
-
-        DG = delayGenerator(DR.histo, DR.histo_name, input_file_name, rebin_num=8, num_optimize_steps=5, reference_point=7, SPECIFY_RUN=args.run)
-    
-        if DG.status == False:
-            continue
-
-        outfile = ROOT.TFile(f"{DG.baseName}/delays/{input_file_name.split('/')[-1].replace('.root','')}_delays.root", "RECREATE")
-        DG.histo.Write()
-
-        for chamber, channels in DG.hotChannels.items():
-            if chamber not in all_hot_channels:
-                all_hot_channels[chamber] = set()
-
-            all_hot_channels[chamber].update(channels)
-
-        DG.float_applied_histo.Write()
-        DG.int_applied_histo.Write()
-        DG.gbt_applied_histo.Write()
+        baseName = "GEM_delays/default"
+        ensure_folders_exist(baseName, subfolders)
+        mcdonalds_dir = "./GEM_mcdonalds_data/default/" #pull all chambers in the GEM_mcdonalds file
+
+    # The McDonalds store holds every non-empty chamber of the run in one memory-mapped file;
+    # older productions (or --root exports) only have the one .root file per chamber
+    store = None
+    if store_exists(mcdonalds_dir):
+        store = mcdonaldsStore(mcdonalds_dir)
+        files = [mcdonalds_dir+name+".root" for name in store.chamber_names()]
+    else:
+        files = glob.glob(mcdonalds_dir+"*.root")
+
+    num_optimize_steps = args.optimize_steps
+    if num_optimize_steps is None:
+        num_optimize_steps = 120 if args.optimizer == "analytic" else 5
+
+    # Reruns on the same McDonalds data with the same fit settings reuse the earlier fit results
+    fit_cache = None
+    if not args.no_fit_cache:
+        fit_cache = fitCache(args.fit_cache, max_size_mb=args.fit_cache_size, clear=args.clear_fit_cache)
+
+    # rebin_num = number of pads you consider together 
+    #       (8 pads = 1 group, whole group gets same correction)
+    #
+    # num_optimize_step = number of increments between 0 and 1 you add to your reference number when 
+    #       optimizing the differences from that reference number
+    #
+    # reference_point is the actual number you subtract the mean timing (per padID) to get estimates for
+    #       the delays needed
+    options = {
+                "rebin_num": 8, 
+                "num_optimize_steps": num_optimize_steps, 
+                "reference_point": 7, 
+                "SPECIFY_RUN": args.run, 
+                "fit_backend": args.fit_backend, 
+                "write_intermediate": args.intermediate, 
+                "optimizer": args.optimizer
+            }
+
+    # Sorted, so that the merged outputs are the same for any number of jobs
+    files = sorted(files)
+
+    # Stage timings, fit counts and a record per chamber of this run
+    metrics = runMetrics(f"{baseName}/metrics.jsonl", step="run", run=args.run, jobs=args.jobs, **{key: value for key, value in options.items() if key != "SPECIFY_RUN"})
+
+    # Everything is collected first and each output file is written once at the end
+    writer = delayOutputWriter(baseName, columnar=args.columnar)
+    progress = progressLine(len(files), unit="chambers", min_interval=0, redraw=False)
+
+    # A chamber that raises is skipped like an empty one (and reported at the end), so the others are still written
+    def chamber_done(input_file_name, get_result):
+        try:
+            result = get_result()
+        except Exception as error:
+            print(f"\033[91mGenerating the delays of {input_file_name} failed, skipping it: {error!r}\033[0m")
+            traceback.print_exc()
+            metrics.record("failed", input=input_file_name, error=repr(error))
+            metrics.count("failed")
+            result = None
+        progress.update(progress.done+1)
+        if result is None:
+            return
+
+        group_df, gbt_df, hot_channels, chamber_metrics = result
+        writer.add(group_df, gbt_df, hot_channels)
+        metrics.times.merge(chamber_metrics["stages"])
+        metrics.record("chamber", **chamber_metrics)
+        for counter in ["fits", "fitted_groups", "fit_cache_hits", "hot_pads"]:
+            metrics.count(counter, chamber_metrics[counter])
+        metrics.count("chambers")
+
+    if args.jobs <= 1:
+        for input_file_name in files:
+            chamber_done(input_file_name, functools.partial(process_chamber, input_file_name, store, fit_cache, options))
+    else:
+        fit_cache_settings = None if fit_cache is None else (fit_cache.directory, args.fit_cache_size)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(_process_chamber_worker, input_file_name, mcdonalds_dir, fit_cache_settings, options) for input_file_name in files]
+            #The results are taken in the order of the files, whichever worker finishes first
+            for input_file_name, future in zip(files, futures):
+                chamber_done(input_file_name, future.result)
 
-        DG.int_differences.Write("integer_differences")
-        DG.gbt_differences.Write("gbt_differences")
+    with metrics.stage("writing outputs"):
+        writer.write()
 
-        outfile.Close()
-    
-        if i==0:
-            DG.group_df.to_csv(
-                    f"{DG.baseName}/delays/group_delays.csv", 
-                    mode='w', 
-                    columns=["padID", "fed", "amc", "oh", "vfat", "group", "bunchDelay"], 
-                    index=False
-                )
-
-            DG.gbt_df.to_csv(
-                    f"{DG.baseName}/delays/gbt_delays.csv", 
-                    mode='w', 
-                    columns=["padID", "fed", "amc", "oh", "gbt", "gbtDelay"], 
-                    index=False
-                )
-
-        else:
-            DG.group_df.to_csv(
-                    f"{DG.baseName}/delays/group_delays.csv", 
-                    mode='a', 
-                    columns=["padID", "fed", "amc", "oh", "vfat", "group", "bunchDelay"], 
-                    index=False, 
-                    header=False
-                )
-
-            DG.gbt_df.to_csv(
-                    f"{DG.baseName}/delays/gbt_delays.csv", 
-                    mode='a', 
-                    columns=["padID", "fed", "amc", "oh", "gbt", "gbtDelay"], 
-                    index=False, 
-                    header=False
-                )
-        print("-------------------------------------------------------------------------------------------------------------\n")
+    #The workers each only bounded the fit cache by their own entries
+    if fit_cache is not None and args.jobs > 1:
+        fit_cache.scan()
+        fit_cache.evict()
 
-        with open(f"{DG.baseName}/all_hot_channels.txt", "w") as f:
-            for chamber, channels in all_hot_channels.items():
-                f.write(f"{chamber}: {sorted(channels)}\n")
+    failed = metrics.counters.get("failed", 0)
+    summary = metrics.close(seconds_per_chamber=metrics.elapsed()/max(metrics.counters.get("chambers", 0), 1), failed=failed)
+    print(f"  {metrics.counters.get('chambers', 0)} chambers at {summary['seconds_per_chamber']:.2f} s per chamber, {metrics.counters.get('fits', 0)} fits ({metrics.counters.get('fit_cache_hits', 0)} from the fit cache)")
 
     print("\n-------------------------------------------------------------------------------------------------------------")
+    if failed > 0:
+        print(f"\033[91mPROCESS COMPLETED, BUT {failed} CHAMBER(S) FAILED (SEE ABOVE)!\033[0m")
+        print("-------------------------------------------------------------------------------------------------------------\n")
+        sys.exit(1)
     print("\033[1;35mPROCESS COMPLETED!\033[0m")
     print("-------------------------------------------------------------------------------------------------------------\n")
@@ -0,0 +1,145 @@
+#Instrumentation of a run: wall and CPU time per stage, peak memory, a live progress line with an ETA, and a JSONL
+#file of metrics records (one json object per line) plus a json summary written at the end of the run.
+#With these it can be seen whether the reading, the matching, the fitting or the pdf rendering is what makes a run slow.
+#Code by Jacob Steenis, 2024/2025
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+#Peak resident memory in MB of this process (or of its finished child processes, e.g. the -j workers)
+def peak_rss_mb(children=False):
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    #ru_maxrss is in kB on Linux and in bytes on macOS
+    return usage.ru_maxrss/(1024*1024 if sys.platform == "darwin" else 1024)
+
+#Wall and CPU time per named stage. Only plain dicts are kept, so the times of a task can be sent back from a
+#worker process and added into the run's times with merge().
+class stageTimes():
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+    def add(self, name, wall, cpu, calls=1):
+        stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        stage["calls"] += calls
+
+    def merge(self, stages):
+        for name, stage in stages.items():
+            self.add(name, stage["wall"], stage["cpu"], stage["calls"])
+
+#One line showing how far the run is, the rate and the estimated time left. On a terminal the line is redrawn in
+#place; in a log file (batch jobs) a new line is printed at most every min_interval seconds.
+#done is what was already done before the start (e.g. checkpointed tasks), which does not count for the rate.
+#redraw=False always prints new lines (for output that has other prints in between the updates).
+class progressLine():
+    def __init__(self, total, done=0, unit="events", min_interval=10, stream=None, redraw=None):
+        self.total = total
+        self.unit = unit
+        self.min_interval = min_interval
+        self.stream = stream if stream is not None else sys.stdout
+        self.interactive = redraw if redraw is not None else (hasattr(self.stream, "isatty") and self.stream.isatty())
+        self.start = time.perf_counter()
+        self.last_print = None
+        self.start_done = done
+        self.done = done
+
+    def update(self, done, force=False):
+        self.done = done
+        now = time.perf_counter()
+        if not self.interactive and not force and self.last_print is not None and now - self.last_print < self.min_interval:
+            return
+        self.last_print = now
+
+        elapsed = now - self.start
+        rate = (done - self.start_done)/elapsed if elapsed > 0 else 0.0
+        line = f"{self.unit.capitalize()}: {done}/{self.total}"
+        if self.total > 0:
+            line += f" ({100*done/self.total:.1f}%)"
+        line += f", {rate:.1f} {self.unit}/s, elapsed {format_seconds(elapsed)}"
+        if 0 < done < self.total and rate > 0:
+            line += f", ETA {format_seconds((self.total - done)/rate)}"
+
+        if self.interactive:
+            self.stream.write("\r\033[K"+line)
+        else:
+            self.stream.write(line+"\n")
+        self.stream.flush()
+
+    def finish(self):
+        self.update(self.done, force=True)
+        if self.interactive:
+            self.stream.write("\n")
+            self.stream.flush()
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+#Metrics of one run. Every record() is appended to [path] right away (so a crashed run still has its records)
+#and close() adds a summary record and writes the same summary to [path without .jsonl]_summary.json.
+class runMetrics():
+    def __init__(self, path, **run_info):
+        self.path = path
+        self.summary_path = path.replace(".jsonl", "")+"_summary.json"
+        self.run_info = run_info
+        self.times = stageTimes()
+        self.counters = {}
+        self.wall_start, self.cpu_start = time.perf_counter(), time.process_time()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "w")
+        self.record("start", **run_info)
+
+    def record(self, kind, **fields):
+        self.file.write(json.dumps({"kind": kind, "time": round(time.perf_counter() - self.wall_start, 6), **fields})+"\n")
+        self.file.flush()
+
+    def stage(self, name):
+        return self.times.stage(name)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def elapsed(self):
+        return time.perf_counter() - self.wall_start
+
+    def summary(self, **extra):
+        summary = {
+                    **self.run_info,
+                    "wall": self.elapsed(),
+                    "cpu": time.process_time() - self.cpu_start,
+                    "peak_rss_mb": peak_rss_mb(),
+                    "peak_rss_mb_workers": peak_rss_mb(children=True),
+                    "stages": self.times.stages,
+                    "counters": self.counters
+                }
+        summary.update(extra)
+        return summary
+
+    def close(self, **extra):
+        summary = self.summary(**extra)
+        self.record("summary", **summary)
+        self.file.close()
+
+        with open(self.summary_path+".tmp", "w") as f:
+            json.dump(summary, f, indent=1)
+        os.replace(self.summary_path+".tmp", self.summary_path)
+
+        print(f"\n\033[1;34mStage timings\033[0m (metrics in {self.path})")
+        for name, stage in summary["stages"].items():
+            print(f"  {name:<24} wall {stage['wall']:9.2f} s   cpu {stage['cpu']:9.2f} s   calls {stage['calls']}")
+        print(f"  Peak memory: {summary['peak_rss_mb']:.0f} MB (workers: {summary['peak_rss_mb_workers']:.0f} MB)")
+        return summary
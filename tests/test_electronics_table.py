@@ -0,0 +1,47 @@
+#Checks the precomputed electronics_table against the original per-bin calc_vfat/calc_gbt/calc_group logic, with the
+#pad IDs taken from the bin centers of a McDonalds histogram rebinned by ROOT (also for rebin_num that do not divide 1536).
+#Usage: python3 -m pytest tests
+#Code by Jacob Steenis, 2024/2025
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from delayClasses import electronics_table
+from mcdonaldsStore import make_mcdonalds_hist
+
+GBT0 = [7,12,13,14,15,23]
+GBT1 = [0,1,2,3,4,5,6,8,16]
+GBT2 = [9,10,11,17,18,19,20,21,22]
+
+def old_vfat(padID):
+    return int(padID/192) + 8*int((padID%192)/64)
+
+def old_gbt(vfat):
+    if vfat in GBT0:
+        return 0
+    elif vfat in GBT1:
+        return 1
+    elif vfat in GBT2:
+        return 2
+    return -9999999999
+
+def old_group(padID, rebin_num):
+    return int(padID/rebin_num)%8
+
+@pytest.mark.parametrize("rebin_num", list(range(1, 33)))
+def test_electronics_table_matches_rebinned_bin_centers(rebin_num):
+    hist = make_mcdonalds_hist(f"test_hist_{rebin_num}")
+    rebinned = hist.RebinX(rebin_num, f"test_rebinned_{rebin_num}")
+    axis = rebinned.GetXaxis()
+
+    # One chamber per station/region is enough: vfat, gbt and group only depend on the x bin
+    for station, region, chamber, layer in [(1, -1, 1, 1), (1, 1, 36, 2), (2, -1, 7, 2), (2, 1, 18, 1)]:
+        table = electronics_table(rebin_num).loc[(station, region, chamber, layer)]
+        assert len(table) == rebinned.GetNbinsX()
+
+        for binx in range(1, rebinned.GetNbinsX()+1):
+            padID = axis.GetBinCenter(binx)
+            row = table.loc[binx]
+            vfat = old_vfat(padID)
+            assert (row["vfat"], row["gbt"], row["group"]) == (vfat, old_gbt(vfat), old_group(padID, rebin_num)), (rebin_num, binx, padID)